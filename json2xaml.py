@@ -1,12 +1,15 @@
 import json
 import sys
+import bisect
 import codecs
-import colorama
-import copy
+import io
 import math
 import re
+import time
+from array import array
 from collections import namedtuple
-from argparse import ArgumentParser
+
+# Importing this module has no side effects, colorama and argparse are only loaded by the command line
 
 __version__ = "0.60"
 
@@ -16,14 +19,35 @@ __version__ = "0.60"
 
 Keyframe = namedtuple('Keyframe', 'time value easing to ti')
 Animation = namedtuple('Animation', 'first keyframes')
+Keys = namedtuple('Keys', 'times easings to ti')
 Transform = namedtuple('Transform', 'anchor position scale rotation opacity')
-Asset = namedtuple('Asset', 'id source layers')
+Asset = namedtuple('Asset', 'id source layers index')
 Font = namedtuple('Font', 'name path family style ascent')
 
 Gradient = namedtuple('Gradient', 'start end length angle stops')
 Stroke = namedtuple('Stroke', 'opacity color gradient width line_cap line_join miter_limit dash_offset dash_array')
 Fill = namedtuple('Fill', 'opacity color gradient fill_rule')
 Paint = namedtuple('Paint', 'fill stroke')
+Variant = namedtuple('Variant', 'viewbox template repeat')
+Tier = namedtuple('Tier', 'name tolerance path_tolerance decimals min_size min_opacity')
+Trim = namedtuple('Trim', 'start end offset mode')
+Geometry = namedtuple('Geometry', 'channels data animated')
+ChannelError = namedtuple('ChannelError', 'target property max_error frame')
+Cost = namedtuple('Cost', 'elements timelines keyframes points clips gradients texts')
+
+# Normalised composition model. It is what the writers consume, so it can be cached between runs
+Shape = namedtuple('Shape', 'ty name value')
+Text = namedtuple('Text', 'color opacity stroke_color stroke_opacity keyframes')
+TextKeyframe = namedtuple('TextKeyframe', 'time text font size weight style tracking baseline fill_color stroke_color stroke')
+Layer = namedtuple('Layer', 'index parent transform mask start end ty ref_id solid_width solid_height solid_color shapes text')
+Layer.__new__.__defaults__ = (None,) * len(Layer._fields)
+Marker = namedtuple('Marker', 'name time duration')
+Composition = namedtuple('Composition', 'name version width height start end fps layers index assets markers')
+
+# Bumped whenever the model or the way it is read changes, invalidating cached compositions
+READER_VERSION = 3
+# Bumped whenever the XAML written for a layer changes, invalidating cached layer fragments
+WRITER_VERSION = 3
 
 LAYER_TYPE_PRECOMP = 0
 LAYER_TYPE_SOLID = 1
@@ -52,12 +76,15 @@ LINE_JOIN_BEVEL = 3
 TRIM_PATH_INDIVIDUALLY = 0
 TRIM_PATH_SIMULTANEOUSLY = 1
 
-def error(msg):
-    print(colorama.Fore.RED + msg)
-    exit(1)
+MATRIX_IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+MAX_DIAGNOSTIC_PATHS = 8
+
+# Optional faster JSON parsers, in order of preference. The standard module is always the fallback
+JSON_BACKENDS = ('orjson', 'simdjson')
 
-def warning(msg):
-    print(colorama.Fore.GREEN + msg)
+# Initial size in bytes of the window decoded by JsonStream, it grows until the value fits
+STREAM_WINDOW = 64 * 1024
 
 def as_list(x):
     return x if type(x) is list else [x]
@@ -65,9 +92,146 @@ def as_list(x):
 def remove_list(x):
     return x[0] if type(x) is list else x
 
+def indent(text, prefix):
+    return ''.join(prefix + line for line in text.splitlines(True)) if prefix else text
+
+json_backends = {}
+
+def find_json_backend(name = None):
+    # Returns the name and 'loads' function of the given JSON backend, or of the fastest one
+    # installed when no name (or 'auto') is given
+    key = name or 'auto'
+    if key not in json_backends:
+        if key == 'json':
+            json_backends[key] = ('json', json.loads)
+        elif key == 'auto':
+            json_backends[key] = ('json', json.loads)
+            for backend in JSON_BACKENDS:
+                try:
+                    json_backends[key] = (backend, __import__(backend).loads)
+                    break
+                except ImportError:
+                    pass
+        elif key in JSON_BACKENDS:
+            try:
+                json_backends[key] = (key, __import__(key).loads)
+            except ImportError:
+                raise ValueError("JSON backend '%s' is not installed" % key)
+        else:
+            raise ValueError("Unknown JSON backend '%s'" % key)
+    return json_backends[key]
+
+def load_json(data, backend = None):
+    # Parses a JSON document (str or bytes). Documents rejected by a fast backend (NaN or huge
+    # integers for example) are parsed again with the standard module so results never change
+    name, loads = find_json_backend(backend)
+    if name != 'json':
+        try:
+            return loads(data)
+        except ValueError:
+            pass
+    return json.loads(data)
+
+def load_document(data, backend = None):
+    # Documents given to the Python API as str or bytes are parsed. Loaded dictionaries are copied,
+    # as reading consumes the JSON objects, so the caller can convert the same one again
+    if isinstance(data, (bytes, bytearray, str)):
+        return load_json(data, backend)
+    import copy
+    return copy.deepcopy(data)
+
+# Types of the composition model, the only ones allowed when loading a cached composition
+CACHE_TYPES = ('Keyframe', 'Animation', 'Keys', 'Track', 'Transform', 'Asset', 'Font', 'Gradient', 'Stroke', 'Fill', 'Paint', \
+    'Trim', 'Geometry', 'Shape', 'Text', 'TextKeyframe', 'Layer', 'Marker', 'Composition')
+
+def load_cache(path):
+    # Returns the (composition, warnings) stored by save_cache() or None if missing or unusable
+    import pickle
+
+    class Unpickler(pickle.Unpickler):
+        def find_class(self, module, name):
+            if module == 'array' and name in ('array', '_array_reconstructor'):
+                return pickle.Unpickler.find_class(self, module, name)
+            if name not in CACHE_TYPES:
+                raise pickle.UnpicklingError("Unexpected type '%s' in cache" % name)
+            return globals()[name]
+
+    try:
+        with open(path, 'rb') as f:
+            version, composition, warnings = Unpickler(f).load()
+        return (composition, warnings) if version == READER_VERSION else None
+    except Exception:
+        return None
+
+def load_fragment(path):
+    # Returns the (body, animations, segment_animations, noesis_namespace, warnings) of a layer
+    # stored by save_fragment() or None if missing or unusable. Fragments only contain built-in types
+    import marshal
+
+    try:
+        with open(path, 'rb') as f:
+            fragment = marshal.load(f)
+        return fragment[1:] if fragment[0] == WRITER_VERSION else None
+    except Exception:
+        return None
+
+def save_fragment(path, fragment):
+    import marshal
+    import os
+
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as f:
+        marshal.dump((WRITER_VERSION,) + tuple(fragment), f)
+    os.replace(temp, path)
+
+def save_cache(path, composition, warnings):
+    # The cache is written to a temporary file and renamed so readers never see a partial file
+    import os
+    import pickle
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as f:
+        pickle.dump((READER_VERSION, composition, warnings), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
+
+def split_path(closed, in_tangents, out_tangents, vertices):
+    # Converts a Bodymovin path to a XAML friendly format: the start point followed by the three
+    # control points of each BezierSegment(Point1, Point2, Point3)
+    count = len(vertices)
+    num_segments = count if closed else count - 1
+    if num_segments <= 0:
+        return [[0, 0]]
+
+    num_in = len(in_tangents)
+    points = [vertices[0]]
+    for i in range(num_segments):
+        cp0 = vertices[i]
+        cp3 = vertices[(i + 1) % count]
+        out_tangent = out_tangents[i]
+        in_tangent = in_tangents[(i + 1) % num_in]
+        points.append([cp0[0] + out_tangent[0], cp0[1] + out_tangent[1]])
+        points.append([cp3[0] + in_tangent[0], cp3[1] + in_tangent[1]])
+        points.append(cp3)
+    return points
+
+def find_lines(points):
+    # Returns for each segment of split points whether it is a straight line, with its control
+    # points at its ends. This is an extreme simplification
+    return [points[i - 1] == points[i] and points[i + 1] == points[i + 2] for i in range(1, len(points), 3)]
+
 def format_float(x):
     return ('%.2f' % x).rstrip('0').rstrip('.')
 
+def format_floats(values):
+    # Same as format_float() for a whole sequence, without a function call per number
+    return [('%.2f' % x).rstrip('0').rstrip('.') for x in values]
+
+def format_matrix(m):
+    # Linear coefficients need more precision than coordinates as their error is scaled by them
+    return '%s,%s,%s,%s,%s,%s' % (('%.4f' % m[0]).rstrip('0').rstrip('.'), ('%.4f' % m[1]).rstrip('0').rstrip('.'), \
+        ('%.4f' % m[2]).rstrip('0').rstrip('.'), ('%.4f' % m[3]).rstrip('0').rstrip('.'), format_float(m[4]), format_float(m[5]))
+
 def format_rgb(obj):
     r = max(min((int)(obj[0] * 255), 255), 0)
     g = max(min((int)(obj[1] * 255), 255), 0)
@@ -108,158 +272,693 @@ def vec2_rot(v, center, angle):
     cos = math.cos(rad)
     return (center[0] + cos * x - sin * y, center[1] + sin * x + cos * y)
 
+def mat2d_mul(a, b):
+    # Concatenates two 2D affine matrices (m11 m12 m21 m22 offsetX offsetY), 'a' is applied first
+    return (a[0] * b[0] + a[1] * b[2], a[0] * b[1] + a[1] * b[3], \
+            a[2] * b[0] + a[3] * b[2], a[2] * b[1] + a[3] * b[3], \
+            a[4] * b[0] + a[5] * b[2] + b[4], a[4] * b[1] + a[5] * b[3] + b[5])
+
+class Track:
+    # Keyframes of one animation channel. Times, easings and tangents are shared by all the channels
+    # of a property and numbers (or points) are packed in a flat array, so paths with many vertices
+    # don't need a Keyframe per vertex and keyframe. Keyframes are only created when accessed
+    __slots__ = ('keys', 'values', 'width', 'dim')
+
+    def __init__(self, keys, values, dim):
+        self.keys = keys
+        self.dim = dim
+        if all(type(v) is float or type(v) is int for v in values):
+            self.values = array('d', values)
+            self.width = 1
+        elif all(type(v) in (list, tuple) and len(v) == 2 and \
+                (type(v[0]) is float or type(v[0]) is int) and (type(v[1]) is float or type(v[1]) is int) for v in values):
+            self.values = array('d', [x for v in values for x in v])
+            self.width = 2
+        else:
+            self.values = tuple(values)
+            self.width = 0
+
+    def __len__(self):
+        return len(self.keys.times)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('keyframe index out of range')
+        keys = self.keys
+        to = keys.to[i]
+        ti = keys.ti[i]
+        return Keyframe(keys.times[i], self.value(i), keys.easings[i], \
+            to[self.dim] if to is not None else None, ti[self.dim] if ti is not None else None)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def value(self, i):
+        if self.width == 2:
+            return (self.values[2 * i], self.values[2 * i + 1])
+        return self.values[i]
+
+    def is_constant(self):
+        values = self.values
+        width = self.width or 1
+        return all(values[i] == values[i % width] for i in range(width, len(values)))
+
+# Keyframes of the animations that are constant in a segment but differ from their base value
+STILL_KEYS = Keys(array('d', [0.0]), [EASING_DISCRETE], [None], [None])
+
+def split_bezier(p0, p1, p2, p3, t):
+    # De Casteljau subdivision of a cubic Bezier, returns the control points of both halves
+    def lerp(a, b):
+        return (a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t)
+    p01 = lerp(p0, p1)
+    p12 = lerp(p1, p2)
+    p23 = lerp(p2, p3)
+    p012 = lerp(p01, p12)
+    p123 = lerp(p12, p23)
+    p0123 = lerp(p012, p123)
+    return (p0, p01, p012, p0123), (p0123, p123, p23, p3)
+
+def clip_easing(easing, a, b):
+    # Easing of the part of a keyframe between the time progresses 'a' and 'b'. KeySplines are cut
+    # and scaled back to the unit square, progresses may overshoot like the source ones. Returns
+    # None when the times of the control points fall out of the square, which XAML doesn't allow
+    if easing == EASING_DISCRETE or easing == EASING_LINEAR or (a == 0 and b == 1):
+        return easing
+
+    sa = spline_parameter(easing, a)
+    sb = spline_parameter(easing, b)
+    curve = ((0.0, 0.0), tuple(easing[0]), tuple(easing[1]), (1.0, 1.0))
+    if sb < 1:
+        curve = split_bezier(*(curve + (sb,)))[0]
+    if sa > 0:
+        curve = split_bezier(*(curve + (sa / sb,)))[1]
+
+    (x0, y0), (x3, y3) = curve[0], curve[3]
+    if x3 - x0 <= 0 or abs(y3 - y0) < 1e-9:
+        return EASING_LINEAR
+
+    points = [(round((x - x0) / (x3 - x0), 4), round((y - y0) / (y3 - y0), 4)) for x, y in curve[1:3]]
+    if not all(0 <= x <= 1 for x, y in points):
+        return None
+    # Written like the source values
+    return [tuple(int(v) if v == int(v) else v for v in point) for point in points]
+
+def clip_keys(keys, start, end):
+    # Keyframes between two frames, re-based to the first one. Values at both ends are interpolated
+    # like XAML does (spatial tangents are ignored by the writer, they are only kept for keyframes
+    # not cut), so each new keyframe is given as (i, j, progress) to interpolate between the values
+    # of the keyframes 'i' and 'j'
+    times = keys.times
+    easings = keys.easings
+    count = len(times)
+
+    def progress(i, frame):
+        return (frame - times[i - 1]) / (times[i] - times[i - 1])
+
+    def at(i, frame):
+        # Value in the keyframe 'i' (bisect_right of the frame)
+        if i == 0:
+            return (0, 0, 0.0)
+        if i == count:
+            return (count - 1, count - 1, 0.0)
+        if easings[i] == EASING_DISCRETE:
+            return (i - 1, i - 1, 0.0)
+        return (i - 1, i, ease(easings[i], progress(i, frame)))
+
+    def append(i, a, b, depth = 0):
+        # Appends the part of the keyframe 'i' between the time progresses 'a' and 'b'. It is cut
+        # in halves while its KeySpline can't be expressed, tiny parts are linear
+        easing = clip_easing(easings[i], a, b)
+        if easing is None:
+            if depth < 8:
+                append(i, a, (a + b) * 0.5, depth + 1)
+                append(i, (a + b) * 0.5, b, depth + 1)
+                return
+            easing = EASING_LINEAR
+        new_times.append((times[i] if b == 1 else times[i - 1] + (times[i] - times[i - 1]) * b) - start)
+        new_easings.append(easing)
+        new_to.append(None)
+        new_ti.append(None)
+        plan.append((i - 1, i, ease(easings[i], b)) if b < 1 else (i, i, 0.0))
+
+    first = bisect.bisect_right(times, start)
+    last = bisect.bisect_left(times, end)
+
+    # Before the first keyframe the value is the base one, it needs no keyframe at the start unless
+    # there are none in the range
+    lead = first > 0 or last == 0
+    new_times = array('d', [0.0] if lead else [])
+    new_easings = [EASING_DISCRETE] if lead else []
+    new_to = [None] if lead else []
+    new_ti = [None] if lead else []
+    plan = [at(first, start)] if lead else []
+
+    for i in range(first, last):
+        if i > 0 and times[i - 1] < start and easings[i] != EASING_DISCRETE:
+            append(i, progress(i, start), 1.0)
+        else:
+            new_times.append(times[i] - start)
+            new_easings.append(easings[i])
+            new_to.append(keys.to[i])
+            new_ti.append(keys.ti[i])
+            plan.append((i, i, 0.0))
+
+    # Keyframe ending the segment, unless it is held until after the end
+    if 0 < last < count and easings[last] != EASING_DISCRETE:
+        append(last, max(progress(last, start), 0.0), progress(last, end))
+
+    return Keys(new_times, new_easings, new_to, new_ti), plan
+
+def interpolate_value(a, b, progress):
+    # Numbers, points and 'AARRGGBB' colors
+    if progress == 0 or a == b:
+        return a
+    if isinstance(a, str):
+        return ''.join(['%02X' % max(min(int(round(x + (y - x) * progress)), 255), 0) \
+            for x, y in zip(bytearray.fromhex(a), bytearray.fromhex(b))])
+    if isinstance(a, tuple):
+        return tuple(x + (y - x) * progress for x, y in zip(a, b))
+    return a + (b - a) * progress
+
+def clip_track(track, keys, plan):
+    # Track of the keys returned by clip_keys()
+    return Track(keys, [interpolate_value(track.value(i), track.value(j), progress) for i, j, progress in plan], track.dim)
+
+def same_value(a, b):
+    # Points are lists or tuples depending on where they were read
+    return (tuple(a) if isinstance(a, list) else a) == (tuple(b) if isinstance(b, list) else b)
+
+# Level of detail tiers written in addition to the full conversion. Tolerances are in source units
+# (pixels, degrees or percentages), coordinates are rounded to the given decimals and elements
+# smaller than 'min_size' pixels or with an opacity (in percent) always below 'min_opacity' are culled
+LOD_TIERS = (
+    Tier('medium', 0.25, 0.25, 1, 1.0, 1.0),
+    Tier('low', 1.0, 1.0, 0, 3.0, 3.0),
+)
+
+# Maximum number of consecutive keyframes replaced by a single linear segment
+MAX_REDUCED_KEYFRAMES = 64
+
+def is_reducible_key(keys, i):
+    # Whether the segment ending in the keyframe 'i' can be merged with others: holds are kept, and
+    # so are spatial tangents as the writer ignores them
+    return keys.easings[i] != EASING_DISCRETE and not any(keys.to[i] or ()) and not any(keys.ti[i] or ())
+
+def reduce_keys(tracks, tolerance):
+    # Indices of the keyframes kept when the ones that a linear segment between their neighbours
+    # predicts within the tolerance are removed. Eased segments are sampled every frame. Tracks
+    # share their keys, a keyframe is only removed when it can be removed from all of them
+    keys = tracks[0].keys
+    times = keys.times
+    count = len(times)
+
+    def samples(a, b):
+        # (i, j, progress, t) of the source values between the keyframes 'a' and 'b', interpolated
+        # between the keyframes 'i' and 'j', at the progress 't' of the segment from 'a' to 'b'
+        duration = times[b] - times[a]
+        for k in range(a + 1, b + 1):
+            frames = []
+            if keys.easings[k] != EASING_LINEAR:
+                frame = math.floor(times[k - 1]) + 1
+                while frame < times[k]:
+                    frames.append(frame)
+                    frame += 1
+            if k < b:
+                frames.append(times[k])
+            for frame in frames:
+                progress = (frame - times[k - 1]) / (times[k] - times[k - 1])
+                yield (k - 1, k, ease(keys.easings[k], progress), (frame - times[a]) / duration)
+
+    def fits(a, b):
+        for i, j, progress, t in samples(a, b):
+            for track in tracks:
+                v = track.values
+                if track.width == 1:
+                    source = v[i] + (v[j] - v[i]) * progress
+                    if abs(v[a] + (v[b] - v[a]) * t - source) > tolerance:
+                        return False
+                else:
+                    dx = v[2 * a] + (v[2 * b] - v[2 * a]) * t - v[2 * i] - (v[2 * j] - v[2 * i]) * progress
+                    dy = v[2 * a + 1] + (v[2 * b + 1] - v[2 * a + 1]) * t - v[2 * i + 1] - (v[2 * j + 1] - v[2 * i + 1]) * progress
+                    if dx * dx + dy * dy > tolerance * tolerance:
+                        return False
+        return True
+
+    kept = [0]
+    for i in range(1, count - 1):
+        a = kept[-1]
+        if i - a < MAX_REDUCED_KEYFRAMES and is_reducible_key(keys, i) and is_reducible_key(keys, i + 1) and fits(a, i + 1):
+            continue
+        kept.append(i)
+    if count > 1:
+        kept.append(count - 1)
+    return kept
+
+def select_keyframes(animations, select):
+    # Keeps the keyframes of numbers and points at the indices returned by 'select' for the tracks
+    # sharing the same keys. Segments replacing removed keyframes are linear
+    groups = {}
+    for animation in animations:
+        if animation.keyframes is not None:
+            groups.setdefault(id(animation.keyframes.keys), []).append(animation.keyframes)
+
+    selected = {}
+    for tracks in groups.values():
+        if any(track.width == 0 for track in tracks):
+            continue
+        kept = select(tracks)
+        if len(kept) < len(tracks[0]):
+            keys = tracks[0].keys
+            easings = [keys.easings[i] if n == 0 or kept[n - 1] == i - 1 else EASING_LINEAR for n, i in enumerate(kept)]
+            new_keys = Keys(array('d', [keys.times[i] for i in kept]), easings, [keys.to[i] for i in kept], [keys.ti[i] for i in kept])
+            for track in tracks:
+                selected[id(track)] = Track(new_keys, [track.value(i) for i in kept], track.dim)
+
+    return [Animation(a.first, selected[id(a.keyframes)]) if id(a.keyframes) in selected else a for a in animations]
+
+def reduce_animations(animations, tolerance):
+    # Removes the keyframes within the tolerance of a linear segment between the kept ones
+    return select_keyframes(animations, lambda tracks: reduce_keys(tracks, tolerance))
+
+def resample_keys(tracks, step):
+    # Indices of the keyframes kept when runs of linear keyframes closer than 'step' frames are
+    # resampled to one keyframe every 'step' frames. The ends of the runs (holds, eased and spatial
+    # keyframes) and the extrema of every channel are always kept
+    keys = tracks[0].keys
+    times = keys.times
+    count = len(times)
+
+    def dense(i):
+        return keys.easings[i] == EASING_LINEAR and is_reducible_key(keys, i) and times[i] - times[i - 1] < step
+
+    def extremum(i):
+        for track in tracks:
+            v = track.values
+            for c in range(track.width):
+                a = v[(i - 1) * track.width + c]
+                b = v[i * track.width + c]
+                n = v[(i + 1) * track.width + c]
+                if (b > a) != (n > b) or (b < a) != (n < b):
+                    return True
+        return False
+
+    kept = [0]
+    for i in range(1, count - 1):
+        if not dense(i) or not dense(i + 1) or times[i] - times[kept[-1]] >= step - 1e-6 or extremum(i):
+            kept.append(i)
+    if count > 1:
+        kept.append(count - 1)
+    return kept
+
+def resample_animations(animations, step):
+    return select_keyframes(animations, lambda tracks: resample_keys(tracks, step))
+
+def round_animation(animation, decimals):
+    # Rounds numbers and points, animations that become constant lose their keyframes
+    def round_value(value):
+        if isinstance(value, (int, float)):
+            return round(value, decimals)
+        return type(value)(round(v, decimals) for v in value)
+
+    first = round_value(animation.first)
+    track = animation.keyframes
+    if track is None or track.width == 0:
+        return Animation(first, track)
+    track = Track(track.keys, [round_value(track.value(i)) for i in range(len(track))], track.dim)
+    return Animation(first, None if track.is_constant() else track)
+
+def max_value(animations):
+    # Largest absolute number of a numeric property, over all its keyframes
+    values = [abs(animations[0].first)]
+    for animation in animations:
+        if animation.keyframes is not None:
+            values.extend(abs(v) for v in animation.keyframes.values)
+    return max(values)
+
+def segment_distance(p, a, b):
+    # Distance from the point 'p' to the segment between 'a' and 'b'
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length = dx * dx + dy * dy
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length)) if length else 0.0
+    return math.hypot(a[0] + dx * t - p[0], a[1] + dy * t - p[1])
+
+def simplify_path(points, tolerance):
+    # Simplifies split points (see split_path) of a static path. Curves with both control points
+    # within the tolerance of their chord become lines, and vertices between lines are removed
+    # while every removed vertex stays within the tolerance of the line replacing them
+    points = [list(p) for p in points]
+    for i in range(1, len(points), 3):
+        p0, c1, c2, p3 = points[i - 1:i + 3]
+        if segment_distance(c1, p0, p3) <= tolerance and segment_distance(c2, p0, p3) <= tolerance:
+            points[i] = list(p0)
+            points[i + 1] = list(p3)
+
+    simplified = points[:1]
+    removed = []
+    for i in range(1, len(points), 3):
+        c1, c2, p3 = points[i:i + 3]
+        line = points[i - 1] == c1 and c2 == p3
+        if line and len(simplified) > 3 and simplified[-3] == simplified[-4] and simplified[-2] == simplified[-1]:
+            start = simplified[-4]
+            candidates = removed + [simplified[-1]]
+            if all(segment_distance(v, start, p3) <= tolerance for v in candidates):
+                simplified[-3:] = [list(start), list(p3), list(p3)]
+                removed = candidates
+                continue
+        simplified.extend([list(c1), list(c2), list(p3)])
+        removed = []
+    return simplified
+
+PATH_DATA_TOKEN = re.compile(r'[A-Za-z]|-?\d+(?:\.\d+)?')
+PATH_DATA_NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+
+def path_size(geometry):
+    # Largest side of the bounds of a static path. Rectangles and ellipses only have a Data string,
+    # made of an absolute move followed by relative lines and arcs, arcs are bounded by their radii
+    if geometry.channels is not None:
+        points = [channel.first for channel in geometry.channels]
+    else:
+        tokens = PATH_DATA_TOKEN.findall(geometry.data)
+        x = y = 0.0
+        points = []
+        i = 0
+        while i < len(tokens):
+            command = tokens[i]
+            if command == 'M':
+                x, y = float(tokens[i + 1]), float(tokens[i + 2])
+                i += 3
+            elif command == 'h':
+                x += float(tokens[i + 1])
+                i += 2
+            elif command == 'v':
+                y += float(tokens[i + 1])
+                i += 2
+            elif command == 'a':
+                rx, ry = float(tokens[i + 1]), float(tokens[i + 2])
+                points.extend([(x - rx, y - ry), (x + rx, y + ry)])
+                x += float(tokens[i + 6])
+                y += float(tokens[i + 7])
+                points.extend([(x - rx, y - ry), (x + rx, y + ry)])
+                i += 8
+            else:
+                i += 1
+            points.append((x, y))
+
+    if not points:
+        return 0.0
+    return max(max(p[0] for p in points) - min(p[0] for p in points), max(p[1] for p in points) - min(p[1] for p in points))
+
+class ConversionError(Exception):
+    def __init__(self, msg, path):
+        Exception.__init__(self, "%s (at %s)" % (msg, path) if path else msg)
+        self.msg = msg
+        self.path = path
+
+class Diagnostics:
+    # Collects the warnings of a conversion. Repeated messages are aggregated with a count and the
+    # first few paths where they were found, so they can be reported once at the end
+    def __init__(self, warnings = None):
+        self.warnings = warnings if warnings is not None else {}
+
+    def warning(self, msg, path):
+        entry = self.warnings.get(msg)
+        if entry is None:
+            self.warnings[msg] = entry = { 'message': msg, 'count': 0, 'paths': [] }
+        entry['count'] += 1
+        if len(entry['paths']) < MAX_DIAGNOSTIC_PATHS and path not in entry['paths']:
+            entry['paths'].append(path)
+
+    def merge(self, other):
+        for entry in other.warnings.values():
+            for path in entry['paths']:
+                self.warning(entry['message'], path)
+            self.warnings[entry['message']]['count'] += entry['count'] - len(entry['paths'])
+
+    def count(self):
+        return sum(entry['count'] for entry in self.warnings.values())
+
+    def report(self):
+        # Machine-readable summary, warnings are kept in order of first appearance
+        return { 'warnings': list(self.warnings.values()), 'count': self.count() }
+
+    def dump(self, file):
+        import colorama
+        for entry in self.warnings.values():
+            count = ' (x%d)' % entry['count'] if entry['count'] > 1 else ''
+            file.write(colorama.Fore.GREEN + entry['message'] + count + colorama.Style.RESET_ALL + '\n')
+
+class JsonStream:
+    # Incremental reader of a JSON object over a buffer (usually a memory-mapped file). Values are
+    # decoded one at a time from a growing window, so memory is proportional to the largest value
+    # decoded and not to the size of the buffer
+    WHITESPACE = re.compile(rb'[ \t\n\r]*')
+    KEY = re.compile(rb'[ \t\n\r]*("(?:[^"\\]|\\.)*")[ \t\n\r]*:[ \t\n\r]*', re.DOTALL)
+    SEPARATOR = re.compile(rb'[ \t\n\r]*([,}\]])')
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.decoder = json.JSONDecoder()
+
+    def expect(self, pos, char):
+        pos = self.WHITESPACE.match(self.buffer, pos).end()
+        if self.buffer[pos:pos + 1] != char:
+            raise ValueError("Expecting '%s' at byte %d" % (char.decode(), pos))
+        return pos + 1
+
+    def separator(self, pos, closing):
+        # Returns the position after the separator following a value and whether it was the last one
+        match = self.SEPARATOR.match(self.buffer, pos)
+        if match is None or match.group(1) not in (b',', closing):
+            raise ValueError("Expecting ',' or '%s' at byte %d" % (closing.decode(), pos))
+        return match.end(), match.group(1) == closing
+
+    def decode(self, pos):
+        # Returns the value starting at the given byte position and the position after it
+        size = STREAM_WINDOW
+        while True:
+            chunk = self.buffer[pos:pos + size]
+            complete = pos + size >= len(self.buffer)
+
+            try:
+                text = chunk.decode('utf-8')
+            except UnicodeDecodeError as e:
+                # The window can split a multi-byte character
+                if complete or e.start < len(chunk) - 3: raise
+                text = chunk[:e.start].decode('utf-8')
+
+            try:
+                value, end = self.decoder.raw_decode(text)
+                # A value reaching the end of the window could be truncated (a number for example)
+                if end < len(text) or complete:
+                    return value, pos + (end if len(text) == len(chunk) else len(text[:end].encode('utf-8')))
+            except ValueError:
+                if complete: raise
+
+            size *= 2
+
+    def read_object(self, pos, read_member):
+        # Calls read_member(key, pos) for each member of the object at 'pos', it must return the
+        # position after the value. Returns the position after the object
+        pos = self.expect(pos, b'{')
+        match = self.SEPARATOR.match(self.buffer, pos)
+        if match and match.group(1) == b'}':
+            return match.end()
+
+        last = False
+        while not last:
+            match = self.KEY.match(self.buffer, pos)
+            if match is None:
+                raise ValueError("Expecting key at byte %d" % pos)
+            pos = read_member(json.loads(match.group(1)), match.end())
+            pos, last = self.separator(pos, b'}')
+        return pos
+
+    def read_array(self, pos, read_item):
+        # Calls read_item(value, pos) with each element of the array at 'pos', decoded one at a time.
+        # Returns the position after the array
+        pos = self.expect(pos, b'[')
+        match = self.SEPARATOR.match(self.buffer, pos)
+        if match and match.group(1) == b']':
+            return match.end()
+
+        last = False
+        while not last:
+            start = self.WHITESPACE.match(self.buffer, pos).end()
+            value, pos = self.decode(start)
+            read_item(value, start)
+            pos, last = self.separator(pos, b']')
+        return pos
+
 class JsonParser:
-    def __init__(self, debug, viewbox, template, repeat):
+    def __init__(self, debug = False, viewbox = False, template = None, repeat = None, verbose = False, diagnostics = None, json_backend = None, jobs = None, cache = None, markers = False, frames = None, group_static = False, max_keyframe_rate = None):
         self.animations = ''
         self.body = ''
         self.context = []
+        self.location = []
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self.layer_name = ''
         self.num_paths = 0
         self.num_groups = 0
         self.num_texts = 0
-        self.assets = []
-        self.fonts = []
+        self.assets = {}
+        self.fonts = {}
         self.noesis_namespace = False
         self.start = 0
         self.end = 0
         self.fps = 0
         self.width = 0
         self.height = 0
+        self.name = ''
+        self.version = ''
         self.debug = debug
+        self.verbose = verbose
+        self.json_backend = json_backend
+        self.jobs = jobs
+        self.cache = cache
+        self.markers = markers
+        self.frames = frames
+        self.group_static = group_static
+        self.max_keyframe_rate = max_keyframe_rate
+        self.segments = None
+        self.segment_animations = []
+        self.clipped_keys = {}
+        self.asset_digests = {}
+        self.emitted = None
+        self.sources = {}
+        self.costs = []
+        self.lod = None
+        self.timings = {}
+        self.time_strings = {}
+        self.keyframe_prefixes = {}
         self.viewbox = viewbox
         self.template = template
         self.repeat = repeat
 
-        if template:
-            if viewbox:
-                self.tab = '      '
-                self.ani_tab = '  '
-            else:
-                self.tab = '    '
-                self.ani_tab = '  '
-        else:
-            if viewbox:
-                self.tab = '  '
-                self.ani_tab = '  '
-            else:
-                self.tab = ''
-                self.ani_tab = ''
 
-    def parse(self, input, output):
-        colorama.init(autoreset = True)
+        # Elements are generated for a root Canvas, they are indented for each layout when wrapped
+        self.tab = ''
 
-        with open(input, 'r') as f:
-            obj = json.load(f)
+    def parse(self, input, output, stream = False, tiers = None):
+        # With 'tiers' a file is also written next to the output for each level of detail tier,
+        # from the same read composition. The (name, file, size, costs) of every file written,
+        # including the output, are kept in 'lod'
+        if stream:
+            # Parsing and conversion are interleaved when streaming, so there is nothing to cache
+            start = time.time()
+            self.read_stream(input)
+            self.timings['convert'] = time.time() - start
+        else:
+            composition = self.read_file(input)
 
-        self.read_composition(obj)
+            start = time.time()
+            self.write_composition(composition)
+            self.timings['convert'] = time.time() - start
 
+        start = time.time()
         with open(output, 'w') as f:
-
-            repeat_behavior = ' RepeatBehavior="%s"' % self.repeat if self.repeat else ""
-
-            if self.template:
-                if self.viewbox:
-                    f.write('<ResourceDictionary\n')
-                    f.write('  xmlns="http://schemas.microsoft.com/winfx/2006/xaml/presentation"\n')
-                    if self.noesis_namespace:
-                        f.write('  xmlns:noesis="clr-namespace:NoesisGUIExtensions;assembly=Noesis.GUI.Extensions"\n')
-                    f.write('  xmlns:x="http://schemas.microsoft.com/winfx/2006/xaml">\n\n')
-
-                    f.write('  <ControlTemplate x:Key="%s" TargetType="Control">\n' % self.template)
-
-                    if self.animations:
-                        f.write('    <ControlTemplate.Resources>\n')
-                        f.write('      <Storyboard x:Key="Anims" Duration="%s"%s>\n' % (self.as_time(self.end - self.start), repeat_behavior))
-                        f.write(self.animations)
-                        f.write('      </Storyboard>\n')
-                        f.write('    </ControlTemplate.Resources>\n\n')
-
-                        f.write('    <ControlTemplate.Triggers>\n')
-                        f.write('      <EventTrigger RoutedEvent="FrameworkElement.Loaded">\n')
-                        f.write('        <BeginStoryboard Storyboard="{StaticResource Anims}"/>\n')
-                        f.write('      </EventTrigger>\n')
-                        f.write('    </ControlTemplate.Triggers>\n\n')
-
-                    f.write('    <Viewbox>\n')
-                    f.write('      <Canvas Width="%d" Height="%d">\n' % (self.width, self.height))
-                    f.write(self.body)
-                    f.write('      </Canvas>\n')
-                    f.write('    </Viewbox>\n')
-                    f.write('  </ControlTemplate>\n')
-                    f.write('\n</ResourceDictionary>')
-                else:
-                    f.write('<ResourceDictionary\n')
-                    f.write('  xmlns="http://schemas.microsoft.com/winfx/2006/xaml/presentation"\n')
-                    if self.noesis_namespace:
-                        f.write('  xmlns:noesis="clr-namespace:NoesisGUIExtensions;assembly=Noesis.GUI.Extensions"\n')
-                    f.write('  xmlns:x="http://schemas.microsoft.com/winfx/2006/xaml">\n\n')
-
-                    f.write('  <ControlTemplate x:Key="%s" TargetType="Control">\n' % self.template)
-
-                    if self.animations:
-                        f.write('    <ControlTemplate.Resources>\n')
-                        f.write('      <Storyboard x:Key="Anims" Duration="%s"%s>\n' % (self.as_time(self.end - self.start), repeat_behavior))
-                        f.write(self.animations)
-                        f.write('      </Storyboard>\n')
-                        f.write('    </ControlTemplate.Resources>\n\n')
-
-                        f.write('    <ControlTemplate.Triggers>\n')
-                        f.write('      <EventTrigger RoutedEvent="FrameworkElement.Loaded">\n')
-                        f.write('        <BeginStoryboard Storyboard="{StaticResource Anims}"/>\n')
-                        f.write('      </EventTrigger>\n')
-                        f.write('    </ControlTemplate.Triggers>\n\n')
-
-                    f.write('    <Canvas Width="%d" Height="%d">\n' % (self.width, self.height))
-                    f.write(self.body)
-                    f.write('    </Canvas>\n')
-                    f.write('  </ControlTemplate>\n')
-                    f.write('\n</ResourceDictionary>')
+            self.write_document(f)
+        self.timings['write'] = time.time() - start
+
+        if tiers:
+            import os
+
+            start = time.time()
+            self.lod = [('full', output, os.path.getsize(output), self.costs)]
+            root, ext = os.path.splitext(output)
+            for tier in tiers:
+                parser = self.write_tier(composition, tier)
+                path = '%s.%s%s' % (root, tier.name, ext)
+                with open(path, 'w') as f:
+                    parser.write_document(f)
+                self.lod.append((tier.name, path, os.path.getsize(path), parser.costs))
+            self.timings['lod'] = time.time() - start
+
+    def write_tier(self, composition, tier):
+        # Returns a parser with the composition written with the reductions of a tier. Its warnings
+        # are not reported, they are the ones of the full conversion
+        parser = JsonParser(self.debug, self.viewbox, self.template, self.repeat, json_backend = self.json_backend, jobs = self.jobs, \
+            cache = self.cache, markers = self.markers, frames = self.frames, group_static = self.group_static, \
+            max_keyframe_rate = self.max_keyframe_rate)
+        parser.write_composition(self.reduce_composition(composition, tier))
+        return parser
+
+    def write_document(self, f, variant = None):
+        # Wraps the generated elements for the requested layout. Many variants can be written
+        # from a single conversion as the layout is only chosen here
+        variant = variant or Variant(self.viewbox, self.template, self.repeat)
+        repeat_behavior = ' RepeatBehavior="%s"' % variant.repeat if variant.repeat else ""
+        noesis = '  xmlns:noesis="clr-namespace:NoesisGUIExtensions;assembly=Noesis.GUI.Extensions"\n' if self.noesis_namespace else ''
+
+        if variant.template:
+            owner = 'ControlTemplate'
+            tab = '    '
+            f.write('<ResourceDictionary\n')
+            f.write('  xmlns="http://schemas.microsoft.com/winfx/2006/xaml/presentation"\n')
+            f.write(noesis)
+            f.write('  xmlns:x="http://schemas.microsoft.com/winfx/2006/xaml">\n\n')
+            f.write('  <ControlTemplate x:Key="%s" TargetType="Control">\n' % variant.template)
+        elif variant.viewbox:
+            owner = 'Canvas'
+            tab = '    '
+            f.write('<Viewbox\n')
+            f.write('  xmlns="http://schemas.microsoft.com/winfx/2006/xaml/presentation"\n')
+            f.write(noesis)
+            f.write('  xmlns:x="http://schemas.microsoft.com/winfx/2006/xaml">\n\n')
+            f.write('  <Canvas Width="%d" Height="%d">\n\n' % (self.width, self.height))
+        else:
+            owner = 'Canvas'
+            tab = '  '
+            f.write('<Canvas\n')
+            f.write('  xmlns="http://schemas.microsoft.com/winfx/2006/xaml/presentation"\n')
+            f.write(noesis)
+            f.write('  xmlns:x="http://schemas.microsoft.com/winfx/2006/xaml"\n')
+            f.write('  Width="%d" Height="%d">\n\n' % (self.width, self.height))
+
+        if self.segments:
+            # Storyboards of the segments are started by the application, none is started when loaded
+            f.write(tab + '<%s.Resources>\n' % owner)
+            for (key, start, end), animations in zip(self.segments, self.segment_animations):
+                key = key.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;')
+                f.write(tab + '  <Storyboard x:Key="%s" Duration="%s"%s>\n' % (key, self.as_time(end - start), repeat_behavior))
+                f.write(indent(animations, tab[2:]))
+                f.write(tab + '  </Storyboard>\n')
+            f.write(tab + '</%s.Resources>\n\n' % owner)
+        elif self.animations:
+            f.write(tab + '<%s.Resources>\n' % owner)
+            f.write(tab + '  <Storyboard x:Key="Anims" Duration="%s"%s>\n' % (self.as_time(self.end - self.start), repeat_behavior))
+            f.write(indent(self.animations, tab[2:]))
+            f.write(tab + '  </Storyboard>\n')
+            f.write(tab + '</%s.Resources>\n\n' % owner)
+            f.write(tab + '<%s.Triggers>\n' % owner)
+            f.write(tab + '  <EventTrigger RoutedEvent="FrameworkElement.Loaded">\n')
+            f.write(tab + '    <BeginStoryboard Storyboard="{StaticResource Anims}"/>\n')
+            f.write(tab + '  </EventTrigger>\n')
+            f.write(tab + '</%s.Triggers>\n\n' % owner)
+
+        if variant.template:
+            if variant.viewbox:
+                f.write('    <Viewbox>\n')
+                f.write('      <Canvas Width="%d" Height="%d">\n' % (self.width, self.height))
+                f.write(indent(self.body, '      '))
+                f.write('      </Canvas>\n')
+                f.write('    </Viewbox>\n')
             else:
-                if self.viewbox:
-                    f.write('<Viewbox\n')
-                    f.write('  xmlns="http://schemas.microsoft.com/winfx/2006/xaml/presentation"\n')
-                    if self.noesis_namespace:
-                        f.write('  xmlns:noesis="clr-namespace:NoesisGUIExtensions;assembly=Noesis.GUI.Extensions"\n')
-                    f.write('  xmlns:x="http://schemas.microsoft.com/winfx/2006/xaml">\n\n')
-
-                    f.write('  <Canvas Width="%d" Height="%d">\n\n' % (self.width, self.height))
-
-                    if self.animations:
-                        f.write('    <Canvas.Resources>\n')
-                        f.write('      <Storyboard x:Key="Anims" Duration="%s">\n' % self.as_time(self.end - self.start))
-                        f.write(self.animations)
-                        f.write('      </Storyboard>\n')
-                        f.write('    </Canvas.Resources>\n\n')
-                        f.write('    <Canvas.Triggers>\n')
-                        f.write('      <EventTrigger RoutedEvent="FrameworkElement.Loaded">\n')
-                        f.write('        <BeginStoryboard Storyboard="{StaticResource Anims}"/>\n')
-                        f.write('      </EventTrigger>\n')
-                        f.write('    </Canvas.Triggers>\n\n')
-
-                    f.write(self.body)
-                    f.write('\n  </Canvas>\n')
-                    f.write('\n</Viewbox>')
-                else:
-                    f.write('<Canvas\n')
-                    f.write('  xmlns="http://schemas.microsoft.com/winfx/2006/xaml/presentation"\n')
-                    if self.noesis_namespace:
-                        f.write('  xmlns:noesis="clr-namespace:NoesisGUIExtensions;assembly=Noesis.GUI.Extensions"\n')
-                    f.write('  xmlns:x="http://schemas.microsoft.com/winfx/2006/xaml"\n')
-                    f.write('  Width="%d" Height="%d">\n\n' % (self.width, self.height))
-
-                    if self.animations:
-                        f.write('  <Canvas.Resources>\n')
-                        f.write('    <Storyboard x:Key="Anims" Duration="%s">\n' % self.as_time(self.end - self.start))
-                        f.write(self.animations)
-                        f.write('    </Storyboard>\n')
-                        f.write('  </Canvas.Resources>\n\n')
-                        f.write('  <Canvas.Triggers>\n')
-                        f.write('    <EventTrigger RoutedEvent="FrameworkElement.Loaded">\n')
-                        f.write('      <BeginStoryboard Storyboard="{StaticResource Anims}"/>\n')
-                        f.write('    </EventTrigger>\n')
-                        f.write('  </Canvas.Triggers>\n\n')
-
-                    f.write(self.body)
-                    f.write('\n</Canvas>')
+                f.write('    <Canvas Width="%d" Height="%d">\n' % (self.width, self.height))
+                f.write(indent(self.body, '    '))
+                f.write('    </Canvas>\n')
+            f.write('  </ControlTemplate>\n')
+            f.write('\n</ResourceDictionary>')
+        elif variant.viewbox:
+            f.write(indent(self.body, '  '))
+            f.write('\n  </Canvas>\n')
+            f.write('\n</Viewbox>')
+        else:
+            f.write(self.body)
+            f.write('\n</Canvas>')
 
     def clear_body(self):
         body = self.body
@@ -272,25 +971,63 @@ class JsonParser:
     def pop_tab(self):
         self.tab = self.tab[:-2]
 
+    # Elements are named after their layer and their position in it, so layers can be written
+    # independently of each other and in any order
+
     def next_path_name(self):
-        name = 'Path%d' % self.num_paths
+        name = '%s_Path%d' % (self.layer_name, self.num_paths)
         self.num_paths += 1
         return name
 
     def next_group_name(self):
-        name = 'Group%d' % self.num_groups
+        name = '%s_Group%d' % (self.layer_name, self.num_groups)
         self.num_groups += 1
         return name
 
     def next_text_name(self):
-        name = 'Text%d' % self.num_texts
+        name = '%s_Text%d' % (self.layer_name, self.num_texts)
         self.num_texts += 1
         return name
 
     def as_time(self, frame):
-        m, s = divmod(frame / float(self.fps), 60)
-        h, m = divmod(m, 60)
-        return "%s:%s:%s" % (format_float(h), format_float(m), format_float(s))
+        # Most keyframes share a few times, so they are memoised for the composition. Zero is never
+        # memoised as -0.0 compares equal to it but is formatted differently
+        text = self.time_strings.get(frame) if frame else None
+        if text is None:
+            m, s = divmod(frame / float(self.fps), 60)
+            h, m = divmod(m, 60)
+            text = "%s:%s:%s" % (format_float(h), format_float(m), format_float(s))
+            if frame:
+                self.time_strings[frame] = text
+        return text
+
+    def format_keyframes(self, keys, kind):
+        # Returns the beginning of each keyframe element, up to its value. They only depend on the
+        # times and easings shared by all the channels of a property, so they are formatted once.
+        # Keys are kept in the memo to make their id stable
+        memo = self.keyframe_prefixes.get((id(keys), kind))
+        if memo is not None:
+            return memo[1]
+
+        prefixes = []
+        for time, easing in zip(keys.times, keys.easings):
+            if easing == EASING_DISCRETE: element = 'Discrete%sKeyFrame' % kind
+            elif easing == EASING_LINEAR: element = 'Linear%sKeyFrame' % kind
+            else: element = 'Spline%sKeyFrame KeySpline="%s,%s %s,%s"' % (kind, easing[0][0], easing[0][1], easing[1][0], easing[1][1])
+            prefixes.append('        <%s KeyTime="%s" Value="' % (element, self.as_time(time)))
+
+        self.keyframe_prefixes[(id(keys), kind)] = (keys, prefixes)
+        return prefixes
+
+    def json_path(self):
+        # Layer names identify the layer (and its precomps), followed by the objects being read
+        return '/'.join(self.location + [c[0] for c in self.context])
+
+    def warning(self, msg):
+        self.diagnostics.warning(msg, self.json_path())
+
+    def error(self, msg):
+        raise ConversionError(msg, self.json_path())
 
     def begin_reading(self, name, obj):
         self.context.append((name, obj))
@@ -304,7 +1041,7 @@ class JsonParser:
         else:
             value = obj.pop(field, None)
             if value is None:
-                error("Field not found '%s.%s'" % (name, field))
+                self.error("Field not found '%s.%s'" % (name, field))
             return value
 
     def end_reading(self):
@@ -312,7 +1049,7 @@ class JsonParser:
         obj = self.context[-1][1]
 
         for k in obj.keys():
-            warning("Ignored field '%s.%s'" % (name, k))
+            self.warning("Ignored field '%s.%s'" % (name, k))
 
         self.context.pop()
 
@@ -325,22 +1062,7 @@ class JsonParser:
             vertices = self.read_field('v')
             self.end_reading()
 
-            # Convert path to XAML friendly format -> BezierSegment(Point1, Point2, Point3)
-            start = [0, 0]
-            segments = []
-            num_segments = len(vertices) if closed else len(vertices) - 1
-            if num_segments > 0:
-                start = vertices[0]
-                cp3 = vertices[0]
-                for i in range(num_segments):
-                    cp0 = cp3
-                    cp1 = [cp0[0] + out_tangents[i][0], cp0[1] + out_tangents[i][1]]
-                    cp3 = vertices[(i + 1) % len(vertices)]
-                    cp2 = [cp3[0] + in_tangents[(i + 1) % len(in_tangents)][0], cp3[1] + in_tangents[(i + 1) % len(in_tangents)][1]]
-                    segments.append((cp1, cp2, cp3))
-
-            # Split into N-dimensional array
-            return [start] + [point for segment in segments for point in segment]
+            return split_path(closed, in_tangents, out_tangents, vertices)
 
         return self.read_animation_impl(obj, split)
 
@@ -357,32 +1079,43 @@ class JsonParser:
         stops = self.read_field('k')
         self.end_reading()
 
-        def interpolate(offset, stops):
-            # Returns the interpolated value at the given offset
-
-            # First, make sure we have values at offset 0 and 1
+        def normalise(stops):
+            # Makes sure there are values at offset 0 and 1, returns the offsets of the stops
             if stops[0][0] != 0:
                 stops.insert(0, (0.0, stops[0][1]))
             if stops[-1][0] != 1:
                 stops.append((1.0, stops[-1][1]))
+            return [stop[0] for stop in stops]
 
-            # Second, find the segment and interpolate
-            for i in range(0, len(stops) - 1):
-                t0 = stops[i][0]
-                t1 = stops[i + 1][0]
-                if offset >= t0 and offset <= t1:
-                    value0 = stops[i][1]
-                    value1 = stops[i + 1][1]
-                    t = (offset - t0) / (t1 - t0)
-
-                    if isinstance(value0, list):
-                        return [(1.0 - t) * value0[0] + t * value1[0], \
-                                (1.0 - t) * value0[1] + t * value1[1], \
-                                (1.0 - t) * value0[2] + t * value1[2]]
-                    else:
-                        return (1.0 - t) * value0 + t * value1
+        def interpolate(offset, stops, offsets):
+            # Returns the interpolated value at the given offset. The segment is the first one
+            # containing the offset, found by bisection unless the offsets are out of order
+            if offsets is None:
+                i = next((i for i in range(len(stops) - 1) if stops[i][0] <= offset <= stops[i + 1][0]), None)
+            else:
+                i = bisect.bisect_left(offsets, offset)
+                if i == len(offsets) or (i == 0 and offsets[0] != offset):
+                    i = None
+                elif i > 0:
+                    i -= 1
+
+            assert(i is not None)
+
+            t0 = stops[i][0]
+            t1 = stops[i + 1][0]
+            value0 = stops[i][1]
+            value1 = stops[i + 1][1]
+            t = (offset - t0) / (t1 - t0)
+
+            if isinstance(value0, list):
+                return [(1.0 - t) * value0[0] + t * value1[0], \
+                        (1.0 - t) * value0[1] + t * value1[1], \
+                        (1.0 - t) * value0[2] + t * value1[2]]
+            else:
+                return (1.0 - t) * value0 + t * value1
 
-            assert(False)
+        def sorted_offsets(offsets):
+            return offsets if all(a <= b for a, b in zip(offsets, offsets[1:])) else None
 
         def split(obj):
             # Format given by Bodymovin (num_stops only refers to rgb stops)
@@ -398,13 +1131,21 @@ class JsonParser:
 
             values = []
 
+            # Each ramp is normalised once, before it is first interpolated. Boundary stops added
+            # to the alpha ramp are also written as gradient stops
+            if alpha_stops and rgb_stops:
+                alpha_offsets = sorted_offsets(normalise(alpha_stops))
+
             for v in rgb_stops:
-                alpha = interpolate(v[0], alpha_stops) if alpha_stops else 1.0
+                alpha = interpolate(v[0], alpha_stops, alpha_offsets) if alpha_stops else 1.0
                 values.append(v[0])
                 values.append(format_rgba(v[1] + [alpha]))
 
+            if alpha_stops:
+                rgb_offsets = sorted_offsets(normalise(rgb_stops))
+
             for v in alpha_stops:
-                rgb = interpolate(v[0], rgb_stops)
+                rgb = interpolate(v[0], rgb_stops, rgb_offsets)
                 values.append(v[0])
                 values.append(format_rgba(rgb + [v[1]]))
 
@@ -438,7 +1179,7 @@ class JsonParser:
 
             expression = self.read_field('x', None)
             if expression:
-                warning("Property expressions not supported")
+                self.warning("Property expressions not supported")
 
             # Keyframes are encoded in Bodymovin as sequences of start value and frame.
             # [
@@ -514,10 +1255,12 @@ class JsonParser:
                 first = split_func(as_list(k))
 
             # TODO: tangents are not correct for Point2 animations
-            values = [Animation(first[i], [Keyframe(key[0], key[1][i], key[2], \
-                key[3][i] if key[3] is not None else None, \
-                key[4][i] if key[4] is not None else None) \
-                for key in keyframes]) for i in range(len(first))]
+            if keyframes:
+                keys = Keys(array('d', [key[0] for key in keyframes]), [key[2] for key in keyframes], \
+                    [key[3] for key in keyframes], [key[4] for key in keyframes])
+                values = [Animation(first[i], Track(keys, [key[1][i] for key in keyframes], i)) for i in range(len(first))]
+            else:
+                values = [Animation(first[i], None) for i in range(len(first))]
 
         else:
             # Separate dimensions for X and Y
@@ -528,43 +1271,65 @@ class JsonParser:
 
         # Remove empty channels
         for i in range(len(values)):
-            if values[i].keyframes is not None:
-                if all(k.value == values[i].keyframes[0].value for k in values[i].keyframes):
-                    values[i] = Animation(values[i].first, None)
+            if values[i].keyframes is not None and values[i].keyframes.is_constant():
+                values[i] = Animation(values[i].first, None)
 
         self.end_reading()
 
         return values
 
+    def emit_animation(self, obj, property, name, scale = 1, offset = 0):
+        # Keeps the source of each animation written, when requested, so it can be compared with the XAML
+        if self.emitted is not None:
+            self.emitted.append((name, property, self.sources.get(id(obj), obj), scale, offset))
+
     def write_float_animation(self, obj, property, name, scale = 1, offset = 0):
         if obj.keyframes:
-            self.animations += self.ani_tab + '      <DoubleAnimationUsingKeyFrames Storyboard.TargetProperty="%s" Storyboard.TargetName="%s">\n' % (property, name)
-            for k in obj.keyframes:
-                if k.easing == EASING_DISCRETE: kind = 'DiscreteDoubleKeyFrame'
-                elif k.easing == EASING_LINEAR: kind = 'LinearDoubleKeyFrame'
-                else: kind = 'SplineDoubleKeyFrame KeySpline="%s,%s %s,%s"' % (k.easing[0][0], k.easing[0][1], k.easing[1][0],k.easing[1][1])
-                self.animations += self.ani_tab + '        <%s KeyTime="%s" Value="%s"/>\n' % (kind, self.as_time(k.time), format_float(k.value * scale + offset))
-            self.animations += self.ani_tab + '      </DoubleAnimationUsingKeyFrames>\n'
+            self.emit_animation(obj, property, name, scale, offset)
+            self.write_timeline(obj, 'Double', property, name, lambda track: \
+                format_floats([v * scale + offset for v in (track.values if track.width == 1 else [k.value for k in track])]))
 
     def write_point_animation(self, obj, property, name):
+        def format_values(track):
+            values = format_floats(track.values if track.width == 2 else [c for k in track for c in (k.value[0], k.value[1])])
+            return [x + ',' + y for x, y in zip(values[0::2], values[1::2])]
+
         if obj.keyframes:
-            self.animations += self.ani_tab + '      <PointAnimationUsingKeyFrames Storyboard.TargetProperty="%s" Storyboard.TargetName="%s">\n' % (property, name)
-            for k in obj.keyframes:
-                if k.easing == EASING_DISCRETE: kind = 'DiscretePointKeyFrame'
-                elif k.easing == EASING_LINEAR: kind = 'LinearPointKeyFrame'
-                else: kind = 'SplinePointKeyFrame KeySpline="%s,%s %s,%s"' % (k.easing[0][0], k.easing[0][1], k.easing[1][0],k.easing[1][1])
-                self.animations += self.ani_tab + '        <%s KeyTime="%s" Value="%s,%s"/>\n' % (kind, self.as_time(k.time), format_float(k.value[0]), format_float(k.value[1]))
-            self.animations += self.ani_tab + '      </PointAnimationUsingKeyFrames>\n'
+            self.emit_animation(obj, property, name)
+            self.write_timeline(obj, 'Point', property, name, format_values)
 
     def write_color_animation(self, obj, property, name):
         if obj.keyframes:
-            self.animations += self.ani_tab + '      <ColorAnimationUsingKeyFrames Storyboard.TargetProperty="%s" Storyboard.TargetName="%s">\n' % (property, name)
-            for k in obj.keyframes:
-                if k.easing == EASING_DISCRETE: kind = 'DiscreteColorKeyFrame'
-                elif k.easing == EASING_LINEAR: kind = 'LinearColorKeyFrame'
-                else: kind = 'SplineColorKeyFrame KeySpline="%s,%s %s,%s"' % (k.easing[0][0], k.easing[0][1], k.easing[1][0],k.easing[1][1])
-                self.animations += self.ani_tab + '        <%s KeyTime="%s" Value="#%s"/>\n' % (kind, self.as_time(k.time), k.value)
-            self.animations += self.ani_tab + '      </ColorAnimationUsingKeyFrames>\n'
+            self.emit_animation(obj, property, name)
+            self.write_timeline(obj, 'Color', property, name, lambda track: ['#%s' % k.value for k in track])
+
+    def write_timeline(self, obj, kind, property, name, format_values):
+        # Writes the keyframes of an animation to the storyboard and, when it is split by markers,
+        # to the storyboard of each segment where the animation changes or differs from its base value
+        self.animations += self.format_timeline(obj.keyframes, kind, property, name, format_values)
+
+        for i, (key, start, end) in enumerate(self.segments or []):
+            track = self.clip_track(obj.keyframes, start, end)
+            if track.is_constant():
+                if same_value(track.value(0), obj.first):
+                    continue
+                track = Track(STILL_KEYS, [track.value(0)], track.dim)
+            self.segment_animations[i] += self.format_timeline(track, kind, property, name, format_values)
+
+    def format_timeline(self, track, kind, property, name, format_values):
+        prefixes = self.format_keyframes(track.keys, kind)
+        return '      <%sAnimationUsingKeyFrames Storyboard.TargetProperty="%s" Storyboard.TargetName="%s">\n' % (kind, property, name) + \
+            ''.join([prefix + value + '"/>\n' for prefix, value in zip(prefixes, format_values(track))]) + \
+            '      </%sAnimationUsingKeyFrames>\n' % kind
+
+    def clip_track(self, track, start, end):
+        # The keys shared by the channels of a property are clipped once per segment. Keys are kept
+        # in the memo to make their id stable
+        memo = self.clipped_keys.get((id(track.keys), start, end))
+        if memo is None:
+            memo = (track.keys,) + clip_keys(track.keys, start, end)
+            self.clipped_keys[(id(track.keys), start, end)] = memo
+        return clip_track(track, memo[1], memo[2])
 
     def read_transform(self, obj):
         self.begin_reading("transform", obj)
@@ -577,10 +1342,10 @@ class JsonParser:
         opacity = self.read_animation_float(self.read_field('o', None))
         skew = self.read_animation_float(self.read_field('sk', None))
         if skew and (skew[0].first != 0 or self.is_animated(skew[0])):
-            warning('Skew not supported')
+            self.warning('Skew not supported')
         skew_axis = self.read_animation_float(self.read_field('sa', None))
         if skew_axis and (skew_axis[0].first != 0 or self.is_animated(skew_axis[0])):
-            warning('Skew Axis not supported')
+            self.warning('Skew Axis not supported')
         self.end_reading()
 
         return Transform(anchor, position, scale, rotation, opacity)
@@ -593,16 +1358,16 @@ class JsonParser:
                 unused_name = self.read_field('nm', None)
                 opacity = self.read_animation_float(self.read_field('o', None))
                 if not self.is_constant(opacity[0], 100):
-                    warning('Mask Opacity not supported')
+                    self.warning('Mask Opacity not supported')
                 expansion = self.read_animation_float2(self.read_field('x', None))
                 if not self.is_constant(expansion[0], 0):
-                    warning('Mask Expansion not supported')
+                    self.warning('Mask Expansion not supported')
                 inverted = self.read_field('inv', False)
                 if inverted:
-                    warning('Inverted Masks not supported')
+                    self.warning('Inverted Masks not supported')
                 mode = self.read_field('mode', 'a')
                 if mode != 'a':
-                    warning('Only "Add" mode supported for Masks')
+                    self.warning('Only "Add" mode supported for Masks')
                 mask.append(self.read_animation_path(self.read_field('pt', None)))
                 self.end_reading()
 
@@ -627,17 +1392,33 @@ class JsonParser:
                obj.scale[0].first != 100 or obj.scale[1].first != 100 or \
                obj.rotation[0].first != 0
 
-    def write_transform_elements(self, root_class, obj, name):
+    def transform_matrix(self, obj):
+        # Same composition as write_transform_elements: Scale and Rotate around the anchor, then Translate
+        sx = obj.scale[0].first / 100.0
+        sy = obj.scale[1].first / 100.0
+        rad = math.radians(obj.rotation[0].first)
+        sin = math.sin(rad)
+        cos = math.cos(rad)
+        m11 = cos * sx
+        m12 = sin * sx
+        m21 = -sin * sy
+        m22 = cos * sy
+        ax = obj.anchor[0].first
+        ay = obj.anchor[1].first
+        return (m11, m12, m21, m22, obj.position[0].first - (m11 * ax + m21 * ay), obj.position[1].first - (m12 * ax + m22 * ay))
+
+    def write_transform_elements(self, root_class, obj, name, matrix = MATRIX_IDENTITY):
         scaling = self.is_animated(obj.scale[0]) or self.is_animated(obj.scale[1]) or obj.scale[0].first != 100 or obj.scale[1].first != 100
         rotating = self.is_animated(obj.rotation[0]) or obj.rotation[0].first != 0
         moving = self.is_animated(obj.position[0]) or self.is_animated(obj.position[1]) or \
             (obj.position[0].first - obj.anchor[0].first) != 0 or (obj.position[1].first - obj.anchor[1].first) != 0
-        num_transforms = scaling + rotating + moving
+        flattening = matrix != MATRIX_IDENTITY
+        num_transforms = scaling + rotating + moving + flattening
         use_group = num_transforms > 1
         align = '  ' if use_group else ''
 
         if self.is_animated(obj.anchor[0]) or self.is_animated(obj.anchor[1]):
-            warning("Animated anchor points not supported")
+            self.warning("Animated anchor points not supported")
 
         self.body += self.tab + '    <%s.RenderTransform>\n' % root_class
         if use_group: self.body += self.tab + '      <TransformGroup>\n'
@@ -693,6 +1474,10 @@ class JsonParser:
                 self.write_float_animation(obj.position[0], 'RenderTransform.X', name, 1.0, -obj.anchor[0].first)
                 self.write_float_animation(obj.position[1], 'RenderTransform.Y', name, 1.0, -obj.anchor[1].first)
 
+        if flattening:
+            # Static parent transforms, appended last so indices of the animated children are kept
+            self.body += align + self.tab + '      <MatrixTransform Matrix="%s"/>\n' % format_matrix(matrix)
+
         if use_group: self.body += self.tab + '      </TransformGroup>\n'
         self.body += self.tab + '    </%s.RenderTransform>\n' % root_class
 
@@ -702,21 +1487,29 @@ class JsonParser:
             mask_animated = mask_animated or any(self.is_animated(v) for v in path)
         return mask_animated
 
+    def format_path_data(self, path):
+        # Path markup syntax for the first value of the given path channels. All the coordinates
+        # are formatted at once
+        coords = format_floats([c for channel in path for c in (channel.first[0], channel.first[1])])
+        points = [x + ',' + y for x, y in zip(coords[0::2], coords[1::2])]
+        data = ['M', points[0]]
+        last_segment = ''
+        i = 1
+        for s in self.gen_segments(path):
+            if s[0] == 'L':
+                data.append('L' if last_segment != 'L' else ' ')
+                data.append(points[i + 2])
+            else:
+                data.append('C' if last_segment != 'C' else ' ')
+                data.append(points[i] + ' ' + points[i + 1] + ',' + points[i + 2])
+            last_segment = s[0]
+            i += 3
+        return ''.join(data)
+
     def write_mask_attributes(self, obj):
         data = ''
         for path in obj:
-            data += 'M%s,%s' % (format_float(path[0].first[0]), format_float(path[0].first[1]))
-            last_segment = ''
-            for s in self.gen_segments(path):
-                if s[0] == 'L':
-                    data += 'L' if last_segment != 'L' else ' '
-                    data += '%s,%s' % (format_float(s[1][0]), format_float(s[1][1]))
-                else:
-                    data += 'C' if last_segment != 'C' else ' '
-                    data += '%s,%s %s,%s,%s,%s' % (format_float(s[1][0]), format_float(s[1][1]), \
-                        format_float(s[2][0]), format_float(s[2][1]), \
-                        format_float(s[3][0]), format_float(s[3][1]))
-                last_segment = s[0]
+            data += self.format_path_data(path)
 
         if data:
             self.body += ' Clip="%s"' % data
@@ -747,35 +1540,47 @@ class JsonParser:
                 self.write_point_animation(path[i + 2], 'Clip.Figures[%d].Segments[%d].Point3' % (figure_idx, segment_idx), name)
 
     def write_visibility_animations(self, name, start, end):
-        write_start = start != 0
-        write_end = end != self.end
-        if write_start or write_end:
-            self.animations += self.ani_tab + '      <ObjectAnimationUsingKeyFrames Storyboard.TargetProperty="Visibility" Storyboard.TargetName="%s">\n' % name
-            if write_start:
-                self.animations += self.ani_tab + '        <DiscreteObjectKeyFrame KeyTime="%s" Value="{x:Static Visibility.Visible}"/>\n' % self.as_time(start)
-            if write_end:
-                self.animations += self.ani_tab + '        <DiscreteObjectKeyFrame KeyTime="%s" Value="{x:Static Visibility.Hidden}"/>\n' % self.as_time(end)
-            self.animations += self.ani_tab + '      </ObjectAnimationUsingKeyFrames>\n'
-
-    def is_line(self, c0, c1, c2, c3):
-        # This is an extreme simplification
-        return c0 == c1 and c2 == c3
+        # Elements starting after the first frame are hidden in the body
+        keyframes = []
+        if start != 0:
+            keyframes.append((start, 'Visible'))
+        if end != self.end:
+            keyframes.append((end, 'Hidden'))
+        self.animations += self.format_visibility(name, keyframes)
+
+        for i, (key, segment_start, segment_end) in enumerate(self.segments or []):
+            keyframes = []
+            if end <= segment_start or start >= segment_end:
+                if start <= 0:
+                    keyframes.append((0, 'Hidden'))
+            else:
+                if start > segment_start or start > 0:
+                    keyframes.append((max(start, segment_start) - segment_start, 'Visible'))
+                if end < segment_end:
+                    keyframes.append((end - segment_start, 'Hidden'))
+            self.segment_animations[i] += self.format_visibility(name, keyframes)
+
+    def format_visibility(self, name, keyframes):
+        if not keyframes:
+            return ''
+        return '      <ObjectAnimationUsingKeyFrames Storyboard.TargetProperty="Visibility" Storyboard.TargetName="%s">\n' % name + \
+            ''.join(['        <DiscreteObjectKeyFrame KeyTime="%s" Value="{x:Static Visibility.%s}"/>\n' % (self.as_time(time), value) \
+                for time, value in keyframes]) + \
+            '      </ObjectAnimationUsingKeyFrames>\n'
 
     def gen_segments(self, path):
-        c0 = path[0].first
+        lines = find_lines([channel.first for channel in path])
         for i in range(1, len(path), 3):
             c1 = path[i].first
             c2 = path[i + 1].first
             c3 = path[i + 2].first
             points_animated = self.is_animated(path[i]) or self.is_animated(path[i + 1]) or self.is_animated(path[i + 2])
 
-            if self.is_line(c0, c1, c2, c3) and not points_animated:
+            if lines[i // 3] and not points_animated:
                 yield('L', c3)
             else:
                 yield('C', c1, c2, c3)
 
-            c0 = c3
-
     def read_paint(self, obj):
         self.begin_reading('paint', obj)
         unused_name = self.read_field('nm', None)
@@ -786,11 +1591,11 @@ class JsonParser:
 
         blend_mode = self.read_field('bm', None)
         if blend_mode is not None and blend_mode != 0:
-            warning("Unsupported FillMode '%d'" % blend_mode)
+            self.warning("Unsupported FillMode '%d'" % blend_mode)
 
         fill_rule = self.read_field('r', FILL_RULE_EVEN_ODD)
         if fill_rule != FILL_RULE_NON_ZERO and fill_rule != FILL_RULE_EVEN_ODD:
-            warning("Unsupported FillRule '%d'" % fill_rule)
+            self.warning("Unsupported FillRule '%d'" % fill_rule)
             fill_rule = FILL_RULE_EVEN_ODD
 
         opacity = self.read_animation_float(self.read_field('o'))
@@ -798,7 +1603,7 @@ class JsonParser:
 
         gradient_type = self.read_field('t', None)
         if gradient_type != None and gradient_type != GRADIENT_LINEAR and gradient_type != GRADIENT_RADIAL:
-            warning("Unsupported Gradient Type '%d'" % gradient_type)
+            self.warning("Unsupported Gradient Type '%d'" % gradient_type)
 
         stops = self.read_animation_gradient(self.read_field('g', None))
         start = self.read_animation_point(self.read_field('s', None))
@@ -822,7 +1627,7 @@ class JsonParser:
         dashes = self.read_field('d', None)
         if dashes:
             if width[0].keyframes:
-                warning('Dash not supported with animated Width')
+                self.warning('Dash not supported with animated Width')
             else:
                 for segment in dashes:
                     self.begin_reading('dash', segment)
@@ -832,7 +1637,7 @@ class JsonParser:
                     self.end_reading()
 
                     if v[0].keyframes:
-                        warning('Animated Dashes not supported')
+                        self.warning('Animated Dashes not supported')
                         dash_array = []
                         break
 
@@ -861,7 +1666,7 @@ class JsonParser:
             gradient = Gradient(start, end, length, angle, stops)
             stroke = Stroke(opacity, None, gradient, width, line_cap, line_join, miter_limit, dash_offset, dash_array)
         else:
-            warning("Unsupported paint type '%d'" % ty)
+            self.warning("Unsupported paint type '%d'" % ty)
 
         return Paint(fill, stroke)
 
@@ -877,16 +1682,16 @@ class JsonParser:
             else:
                 # Radial Gradient Brush
                 if obj.gradient.start[0].keyframes:
-                    warning('Radial animated Start Point not supported')
+                    self.warning('Radial animated Start Point not supported')
 
                 if obj.gradient.end[0].keyframes:
-                    warning('Radial animated End Point not supported')
+                    self.warning('Radial animated End Point not supported')
 
                 if obj.gradient.length[0].keyframes:
-                    warning('Radial animated Hightlight Length not supported')
+                    self.warning('Radial animated Hightlight Length not supported')
 
                 if obj.gradient.angle[0].keyframes:
-                    warning('Radial animated Hightlight Angle not supported')
+                    self.warning('Radial animated Hightlight Angle not supported')
 
             for i in range(0, len(obj.gradient.stops), 2):
                 self.write_float_animation(obj.gradient.stops[i], "%s.GradientStops[%d].Offset" % (kind, i / 2), name)
@@ -1000,125 +1805,143 @@ class JsonParser:
 
             self.body += self.tab + '      </Path.%s>\n' % kind
 
-    def write_paths(self, obj, paint_, operators):
-        paths = []
-        path_animated = False
-
-        # Copy the path because it can be read more than once
-        for path in copy.deepcopy(obj):
-            if path['ty'] == 'sh':
-                self.begin_reading('shape', path)
-                unused_ix = self.read_field('ix', None)
-                unused_ind = self.read_field('ind', None)
-                unused_name = self.read_field('nm', None)
-                unused_match_name = self.read_field('mn', None)
-                unused_hidden = self.read_field('hd', None)
-                unused_ty = self.read_field('ty', None)
-                geometry = self.read_animation_path(self.read_field('ks'))
-                path_animated = path_animated or any(self.is_animated(v) for v in geometry)
-                paths.append((geometry))
-                self.end_reading()
-            elif path['ty'] == 'rc':
-                self.begin_reading('rectangle', path)
-                unused_name = self.read_field('nm', None)
-                unused_match_name = self.read_field('mn', None)
-                unused_hidden = self.read_field('hd', None)
-                unused_ty = self.read_field('ty', None)
-                direction = self.read_field('d')
-                size = self.read_animation_point(self.read_field('s'))
-                position = self.read_animation_point(self.read_field('p'))
-                roundness = self.read_animation_float(self.read_field('r'))
-                self.end_reading()
-
-                path_animated = False
-                if self.is_animated(size[0]) or self.is_animated(position[0]) or self.is_animated(roundness[0]):
-                    warning('Animated Rectangles not supported')
+    def read_path(self, obj):
+        # Returns the animated channels of shapes. Rectangles and ellipses only have a Data string
+        geometry = None
 
-                w = size[0].first[0]
-                h = size[0].first[1]
-                x = position[0].first[0]
-                y = position[0].first[1]
-                r = min(roundness[0].first, w * 0.5, h * 0.5)
+        if obj['ty'] == 'sh':
+            self.begin_reading('shape', obj)
+            unused_ix = self.read_field('ix', None)
+            unused_ind = self.read_field('ind', None)
+            unused_name = self.read_field('nm', None)
+            unused_match_name = self.read_field('mn', None)
+            unused_hidden = self.read_field('hd', None)
+            unused_ty = self.read_field('ty', None)
+            channels = self.read_animation_path(self.read_field('ks'))
+            self.end_reading()
 
-                geometry = ""
+            # Data string is only needed when the path is not animated
+            animated = any(self.is_animated(v) for v in channels)
+            geometry = Geometry(channels, None if animated else self.format_path_data(channels), animated)
 
-                if r == 0:
-                    if direction == 3:
-                        geometry += "M%s,%s" % (format_float(x + w * 0.5), format_float(y - h * 0.5))
-                        geometry += "h%s" % format_float(-w)
-                        geometry += "v%s" % format_float(h)
-                        geometry += "h%s" % format_float(w)
-                    else:
-                        geometry += "M%s,%s" % (format_float(x + w * 0.5), format_float(y - h * 0.5))
-                        geometry += "v%s" % format_float(h)
-                        geometry += "h%s" % format_float(-w)
-                        geometry += "v%s" % format_float(-h)
-                else:
-                    if direction == 3:
-                        geometry += "M%s,%s" % (format_float(x + w * 0.5), format_float(y - h * 0.5 + r))
-                        geometry += "a%s,%s,0,0,0,%s,%s" % (format_float(r), format_float(r), format_float(-r), format_float(-r))
-                        if w - 2 * r > 0:
-                            geometry += "h%s" % format_float(2 * r - w)
-                        geometry += "a%s,%s,0,0,0,%s,%s" % (format_float(r), format_float(r), format_float(-r), format_float(r))
-                        if h - 2 * r > 0:
-                            geometry += "v%s" % format_float(h - 2 * r)
-                        geometry += "a%s,%s,0,0,0,%s,%s" % (format_float(r), format_float(r), format_float(r), format_float(r))
-                        if w - 2 * r > 0:
-                            geometry += "h%s" % format_float(w - 2 * r)
-                        geometry += "a%s,%s,0,0,0,%s,%s" % (format_float(r), format_float(r), format_float(r), format_float(-r))
-                        if h - 2 * r > 0:
-                            geometry += "v%s" % format_float(2 * r - h)
-                    else:
-                        geometry += "M%s,%s" % (format_float(x + w * 0.5), format_float(y - h * 0.5 + r))
-                        if h - 2 * r > 0:
-                            geometry += "v%s" % format_float(h - 2 * r)
-                        geometry += "a%s,%s,0,0,1,%s,%s" % (format_float(r), format_float(r), format_float(-r), format_float(r))
-                        if w - 2 * r > 0:
-                            geometry += "h%s" % format_float(2 * r - w)
-                        geometry += "a%s,%s,0,0,1,%s,%s" % (format_float(r), format_float(r), format_float(-r), format_float(-r))
-                        if h - 2 * r > 0:
-                            geometry += "v%s" % format_float(2 * r - h)
-                        geometry += "a%s,%s,0,0,1,%s,%s" % (format_float(r), format_float(r), format_float(r), format_float(-r))
-                        if w - 2 * r > 0:
-                            geometry += "h%s" % format_float(w - 2 * r)
-                        geometry += "a%s,%s,0,0,1,%s,%s" % (format_float(r), format_float(r), format_float(r), format_float(r))
-
-                geometry += "Z"
-                paths.append(geometry)
-
-            elif path['ty'] == 'el':
-                self.begin_reading('ellipse', path)
-                unused_name = self.read_field('nm', None)
-                unused_match_name = self.read_field('mn', None)
-                unused_hidden = self.read_field('hd', None)
-                unused_ty = self.read_field('ty', None)
-                direction = self.read_field('d')
-                size = self.read_animation_point(self.read_field('s'))
-                position = self.read_animation_point(self.read_field('p'))
-                self.end_reading()
+        elif obj['ty'] == 'rc':
+            self.begin_reading('rectangle', obj)
+            unused_name = self.read_field('nm', None)
+            unused_match_name = self.read_field('mn', None)
+            unused_hidden = self.read_field('hd', None)
+            unused_ty = self.read_field('ty', None)
+            direction = self.read_field('d')
+            size = self.read_animation_point(self.read_field('s'))
+            position = self.read_animation_point(self.read_field('p'))
+            roundness = self.read_animation_float(self.read_field('r'))
+            self.end_reading()
 
-                path_animated = False
-                if self.is_animated(size[0]) or self.is_animated(position[0]):
-                    warning('Animated Ellipses not supported')
+            if self.is_animated(size[0]) or self.is_animated(position[0]) or self.is_animated(roundness[0]):
+                self.warning('Animated Rectangles not supported')
 
-                rx = size[0].first[0] * 0.5
-                ry = size[0].first[1] * 0.5
-                x = position[0].first[0]
-                y = position[0].first[1]
+            w = size[0].first[0]
+            h = size[0].first[1]
+            x = position[0].first[0]
+            y = position[0].first[1]
+            r = min(roundness[0].first, w * 0.5, h * 0.5)
 
-                geometry = ""
+            data = ""
 
+            if r == 0:
+                if direction == 3:
+                    data += "M%s,%s" % (format_float(x + w * 0.5), format_float(y - h * 0.5))
+                    data += "h%s" % format_float(-w)
+                    data += "v%s" % format_float(h)
+                    data += "h%s" % format_float(w)
+                else:
+                    data += "M%s,%s" % (format_float(x + w * 0.5), format_float(y - h * 0.5))
+                    data += "v%s" % format_float(h)
+                    data += "h%s" % format_float(-w)
+                    data += "v%s" % format_float(-h)
+            else:
                 if direction == 3:
-                    geometry += "M%s,%s" % (format_float(x), format_float(y - ry))
-                    geometry += "a%s,%s,0,0,0,%s,%s" % (format_float(rx), format_float(ry), format_float(0.0), format_float(2 * ry))
-                    geometry += "a%s,%s,0,0,0,%s,%s" % (format_float(rx), format_float(ry), format_float(0.0), format_float(-2 * ry))
+                    data += "M%s,%s" % (format_float(x + w * 0.5), format_float(y - h * 0.5 + r))
+                    data += "a%s,%s,0,0,0,%s,%s" % (format_float(r), format_float(r), format_float(-r), format_float(-r))
+                    if w - 2 * r > 0:
+                        data += "h%s" % format_float(2 * r - w)
+                    data += "a%s,%s,0,0,0,%s,%s" % (format_float(r), format_float(r), format_float(-r), format_float(r))
+                    if h - 2 * r > 0:
+                        data += "v%s" % format_float(h - 2 * r)
+                    data += "a%s,%s,0,0,0,%s,%s" % (format_float(r), format_float(r), format_float(r), format_float(r))
+                    if w - 2 * r > 0:
+                        data += "h%s" % format_float(w - 2 * r)
+                    data += "a%s,%s,0,0,0,%s,%s" % (format_float(r), format_float(r), format_float(r), format_float(-r))
+                    if h - 2 * r > 0:
+                        data += "v%s" % format_float(2 * r - h)
                 else:
-                    geometry += "M%s,%s" % (format_float(x), format_float(y - ry))
-                    geometry += "a%s,%s,0,0,1,%s,%s" % (format_float(rx), format_float(ry), format_float(0.0), format_float(2 * ry))
-                    geometry += "a%s,%s,0,0,1,%s,%s" % (format_float(rx), format_float(ry), format_float(0.0), format_float(-2 * ry))
+                    data += "M%s,%s" % (format_float(x + w * 0.5), format_float(y - h * 0.5 + r))
+                    if h - 2 * r > 0:
+                        data += "v%s" % format_float(h - 2 * r)
+                    data += "a%s,%s,0,0,1,%s,%s" % (format_float(r), format_float(r), format_float(-r), format_float(r))
+                    if w - 2 * r > 0:
+                        data += "h%s" % format_float(2 * r - w)
+                    data += "a%s,%s,0,0,1,%s,%s" % (format_float(r), format_float(r), format_float(-r), format_float(-r))
+                    if h - 2 * r > 0:
+                        data += "v%s" % format_float(2 * r - h)
+                    data += "a%s,%s,0,0,1,%s,%s" % (format_float(r), format_float(r), format_float(r), format_float(-r))
+                    if w - 2 * r > 0:
+                        data += "h%s" % format_float(w - 2 * r)
+                    data += "a%s,%s,0,0,1,%s,%s" % (format_float(r), format_float(r), format_float(r), format_float(r))
+
+            geometry = Geometry(None, data + "Z", False)
+
+        elif obj['ty'] == 'el':
+            self.begin_reading('ellipse', obj)
+            unused_name = self.read_field('nm', None)
+            unused_match_name = self.read_field('mn', None)
+            unused_hidden = self.read_field('hd', None)
+            unused_ty = self.read_field('ty', None)
+            direction = self.read_field('d')
+            size = self.read_animation_point(self.read_field('s'))
+            position = self.read_animation_point(self.read_field('p'))
+            self.end_reading()
+
+            if self.is_animated(size[0]) or self.is_animated(position[0]):
+                self.warning('Animated Ellipses not supported')
+
+            rx = size[0].first[0] * 0.5
+            ry = size[0].first[1] * 0.5
+            x = position[0].first[0]
+            y = position[0].first[1]
+
+            data = ""
+
+            if direction == 3:
+                data += "M%s,%s" % (format_float(x), format_float(y - ry))
+                data += "a%s,%s,0,0,0,%s,%s" % (format_float(rx), format_float(ry), format_float(0.0), format_float(2 * ry))
+                data += "a%s,%s,0,0,0,%s,%s" % (format_float(rx), format_float(ry), format_float(0.0), format_float(-2 * ry))
+            else:
+                data += "M%s,%s" % (format_float(x), format_float(y - ry))
+                data += "a%s,%s,0,0,1,%s,%s" % (format_float(rx), format_float(ry), format_float(0.0), format_float(2 * ry))
+                data += "a%s,%s,0,0,1,%s,%s" % (format_float(rx), format_float(ry), format_float(0.0), format_float(-2 * ry))
+
+            geometry = Geometry(None, data + "Z", False)
+
+        return geometry
+
+    def read_trim_path(self, obj):
+        self.begin_reading('trim_path', obj)
+        start = self.read_animation_float(self.read_field('s'))
+        end = self.read_animation_float(self.read_field('e'))
+        offset = self.read_animation_float(self.read_field('o'))
+        mode = self.read_field('m')
+        unused_ix = self.read_field('ix', None)
+        unused_name = self.read_field('nm', None)
+        unused_match_name = self.read_field('mn', None)
+        unused_hidden = self.read_field('hd', None)
+        unused_ty = self.read_field('ty', None)
+        self.end_reading()
+
+        return Trim(start, end, offset, mode)
 
-                geometry += "Z"
-                paths.append(geometry)
+    def write_paths(self, paths, paint, operators):
+        # Rectangles and ellipses are always static, animated shapes are only kept when not mixed with them
+        path_animated = all(path.channels is not None for path in paths) and any(path.animated for path in paths)
 
         trim_start = None
         trim_end = None
@@ -1127,29 +1950,19 @@ class JsonParser:
 
         if operators:
             if len(operators) > 1:
-                warning("More than one path operators not implemented")
+                self.warning("More than one path operators not implemented")
 
-            self.begin_reading('trim_path', copy.deepcopy(operators[0]))
-            trim_start = self.read_animation_float(self.read_field('s'))
-            trim_end = self.read_animation_float(self.read_field('e'))
-            trim_offset = self.read_animation_float(self.read_field('o'))
-            m = self.read_field('m')
+            trim_start = operators[0].start
+            trim_end = operators[0].end
+            trim_offset = operators[0].offset
 
-            if m == TRIM_PATH_SIMULTANEOUSLY and len(paths) > 1:
-                warning("Trim Path 'Simultaneously' mode not implemented")
-
-            unused_ix = self.read_field('ix', None)
-            unused_name = self.read_field('nm', None)
-            unused_match_name = self.read_field('mn', None)
-            unused_hidden = self.read_field('hd', None)
-            unused_ty = self.read_field('ty', None)
-            self.end_reading()
+            if operators[0].mode == TRIM_PATH_SIMULTANEOUSLY and len(paths) > 1:
+                self.warning("Trim Path 'Simultaneously' mode not implemented")
 
             trim_animated = self.is_animated(trim_start[0]) or self.is_animated(trim_end[0]) or self.is_animated(trim_offset[0])
 
         self.body += self.tab + '    <Path'
         path_name = self.next_path_name()
-        paint = self.read_paint(paint_)
         paint_animated = self.write_paint_animations(paint, path_name)
 
         if path_animated or trim_animated or paint_animated:
@@ -1180,7 +1993,7 @@ class JsonParser:
             self.body += '>\n'
             self.body += self.tab + '      <Path.Data>\n'
             self.body += self.tab +  '        <PathGeometry%s>\n' % (' FillRule="Nonzero"' if fill_rule == FILL_RULE_NON_ZERO else '')
-            for path in paths:
+            for path in (path.channels for path in paths):
                 self.body += self.tab +  '          <PathFigure StartPoint="%s,%s">\n' % (format_float(path[0].first[0]), format_float(path[0].first[1]))
                 for s in self.gen_segments(path):
                     if s[0] == 'L':
@@ -1195,7 +2008,7 @@ class JsonParser:
             self.body += self.tab + '    </Path>\n'
 
             for figure_idx in range(len(paths)):
-                path = paths[figure_idx]
+                path = paths[figure_idx].channels
                 self.write_point_animation(path[0], 'Data.Figures[%d].StartPoint' % figure_idx, path_name)
 
                 for i in range(1, len(path), 3):
@@ -1207,58 +2020,98 @@ class JsonParser:
         else:
             data = 'F1' if fill_rule == FILL_RULE_NON_ZERO else ''
             for path in paths:
-                if isinstance(path, str):
-                    data += path
-                else:
-                    data += 'M%s,%s' % (format_float(path[0].first[0]), format_float(path[0].first[1]))
-                    last_segment = ''
-                    for s in self.gen_segments(path):
-                        if s[0] == 'L':
-                            data += 'L' if last_segment != 'L' else ' '
-                            data += '%s,%s' % (format_float(s[1][0]), format_float(s[1][1]))
-                        else:
-                            data += 'C' if last_segment != 'C' else ' '
-                            data += '%s,%s %s,%s,%s,%s' % (format_float(s[1][0]), format_float(s[1][1]), \
-                                format_float(s[2][0]), format_float(s[2][1]), \
-                                format_float(s[3][0]), format_float(s[3][1]))
-                        last_segment = s[0]
+                data += path.data if path.data is not None else self.format_path_data(path.channels)
             self.body += ' Data="%s"' % data
 
             body = self.clear_body()
             self.write_paint_elements(paint)
 
             if self.body:
-                self.body = body + '>\n' + self.body + '    </Path>\n'
+                self.body = body + '>\n' + self.body + self.tab + '    </Path>\n'
             else:
                 self.body = body + '/>\n'
 
-    def is_paint_attr(self, obj):
-        ty = obj['ty']
+    def is_paint_attr(self, ty):
         return ty == 'fl' or ty == 'gf' or ty == 'st' or ty == 'gs'
 
-    def is_path_attr(self, obj):
-        ty = obj['ty']
+    def is_path_attr(self, ty):
         return ty == 'sh' or ty == 'el' or ty == 'rc'
 
-    def is_group_attr(self, obj):
-        return obj['ty'] == 'gr'
+    def is_group_attr(self, ty):
+        return ty == 'gr'
 
-    def is_transform_attr(self, obj):
-        return obj['ty'] == 'tr'
+    def is_transform_attr(self, ty):
+        return ty == 'tr'
 
-    def is_operator_attr(self, obj):
-        return obj['ty'] == 'tm'
+    def is_operator_attr(self, ty):
+        return ty == 'tm'
 
-    def write_shapes(self, obj, operators = []):
-        close_transform = False
-        group_operators = list(operators)
+    def read_shapes(self, obj):
+        # Paths after the last paint are never rendered and paints without paths before them are
+        # never applied, so neither of them is read
+        types = [node['ty'] for node in obj]
+        paints = [i for i in range(len(obj)) if self.is_paint_attr(types[i])]
+        last_paint = paints[-1] if paints else 0
+        num_paths = 0
+        shapes = []
 
-        # Collect paths for each paint. Paints are rendered in reverse order
-        for i in reversed(range(len(obj))):
+        for i in range(len(obj)):
             node = obj[i]
+            ty = types[i]
+            name = node.get('nm', None)
+            value = None
+
+            if self.is_transform_attr(ty):
+                value = self.read_transform(node)
+
+            elif self.is_paint_attr(ty):
+                if num_paths:
+                    value = self.read_paint(node)
+
+            elif self.is_operator_attr(ty):
+                value = self.read_trim_path(node)
+
+            elif self.is_path_attr(ty):
+                if i < last_paint:
+                    value = self.read_path(node)
+                    num_paths += 1
+
+            elif self.is_group_attr(ty):
+                value = self.read_shapes(node['it'])
+
+            else:
+                self.warning("Unsupported shape attribute '%s'" % ty)
+
+            shapes.append(Shape(ty, name, value))
 
-            if self.is_transform_attr(node):
-                transform = self.read_transform(node)
+        return shapes
+
+    def write_shapes(self, shapes, operators = []):
+        close_transform = False
+        group_operators = list(operators)
+
+        # Each paint applies to the paths and operators found before it, so only their count at
+        # each position needs to be recorded
+        paths = []
+        trims = []
+        num_paths = []
+        num_trims = []
+
+        for shape in shapes:
+            num_paths.append(len(paths))
+            num_trims.append(len(trims))
+            if self.is_operator_attr(shape.ty):
+                trims.append(shape.value)
+            elif self.is_path_attr(shape.ty) and shape.value is not None:
+                paths.append(shape.value)
+
+        # Paints are rendered in reverse order
+        for i in reversed(range(len(shapes))):
+            ty = shapes[i].ty
+            value = shapes[i].value
+
+            if self.is_transform_attr(ty):
+                transform = value
                 if self.has_transform_elements(transform) or transform.opacity[0].first != 100 or self.is_animated(transform.opacity[0]):
                     close_transform = True
                     self.push_tab()
@@ -1276,43 +2129,28 @@ class JsonParser:
                     if self.has_transform_elements(transform):
                         self.write_transform_elements("Canvas", transform, name)
 
-            elif self.is_paint_attr(node):
-                paths = []
-                paint_operators = []
-
+            elif self.is_paint_attr(ty):
                 # Apply paint to paths found before this paint
-                for j in reversed(range(i)):
-                    if self.is_path_attr(obj[j]):
-                        paths.append(obj[j])
-                    elif self.is_operator_attr(obj[j]):
-                        paint_operators.append(obj[j])
+                if num_paths[i]:
+                    self.write_paths(paths[:num_paths[i]][::-1], value, group_operators + trims[:num_trims[i]][::-1])
 
-                if paths:
-                    self.write_paths(paths, node, group_operators + paint_operators)
+            elif self.is_operator_attr(ty):
+                group_operators.append(value)
 
-            elif self.is_operator_attr(node):
-                group_operators.append(node)
-
-            elif self.is_path_attr(node):
-                pass
-
-            elif self.is_group_attr(node):
-                self.write_shapes(node['it'], group_operators)
-
-            else:
-                warning("Unsupported shape attribute '%s'" % node['ty'])
+            elif self.is_group_attr(ty):
+                self.write_shapes(value, group_operators)
 
         if close_transform:
             self.body += self.tab + '  </Canvas>\n'
             self.pop_tab()
 
-    def dump_shapes(self, obj, level = 0):
-        for shape in obj:
-            print('  %s- %s - %s' % (' ' * level, shape['ty'].upper(), shape['nm']))
-            if shape['ty'] == 'gr':
-                self.dump_shapes(shape['it'], level + 1)
+    def dump_shapes(self, shapes, level = 0):
+        for shape in shapes:
+            print('  %s- %s - %s' % (' ' * level, shape.ty.upper(), shape.name))
+            if self.is_group_attr(shape.ty):
+                self.dump_shapes(shape.value, level + 1)
 
-    def write_text(self, obj):
+    def read_text(self, obj):
         self.begin_reading('text_data', obj)
         unused_more_options = self.read_field('m', None)
         unused_path = self.read_field('p', None)
@@ -1344,8 +2182,7 @@ class JsonParser:
             stroke_opacity_animation = stroke_opacity_animation or self.read_animation_float(self.read_field('so', None))
             self.end_reading()
 
-        names = []
-        times = []
+        text_keyframes = []
 
         for k in keyframes:
             self.begin_reading('text_keyframe', k)
@@ -1369,7 +2206,7 @@ class JsonParser:
             self.end_reading()
 
             if justify != 0:
-                warning('Only Left-Aligned text is supported. Please change to "Left Align Text" and adjust "Anchor Point"')
+                self.warning('Only Left-Aligned text is supported. Please change to "Left Align Text" and adjust "Anchor Point"')
 
             font = self.find_font(font_name)
             ascent = font.ascent * size / 100
@@ -1401,96 +2238,143 @@ class JsonParser:
 
             if re.search("Italic", font.style, re.IGNORECASE): style = "Italic"
 
-            text = text.replace('\r', '&#x0a;')
+            text = text.replace('\r', '&#x0a;').replace('\n', '&#x0a;')
+
+            text_keyframes.append(TextKeyframe(time, text, font, size, weight, style, tracking, \
+                baseline + baseline_shift, fill_color, stroke_color, stroke))
 
+        return Text(color_animation, opacity_animation, stroke_color_animation, stroke_opacity_animation, text_keyframes)
+
+    def write_text(self, obj):
+        names = []
+        times = []
+
+        for k in obj.keyframes:
             self.body += self.tab + '  <TextBlock'
 
             name = None
 
-            if len(keyframes) > 1:
+            if len(obj.keyframes) > 1:
                 name = name or self.next_text_name()
 
-            if color_animation and self.is_animated(color_animation[0]):
+            if obj.color and self.is_animated(obj.color[0]):
                 name = name or self.next_text_name()
-                self.write_color_animation(color_animation[0], "Foreground.Color", name)
+                self.write_color_animation(obj.color[0], "Foreground.Color", name)
 
-            if opacity_animation and self.is_animated(opacity_animation[0]):
+            if obj.opacity and self.is_animated(obj.opacity[0]):
                 name = name or self.next_text_name()
-                self.write_float_animation(opacity_animation[0], "Foreground.Opacity", name, 0.01)
+                self.write_float_animation(obj.opacity[0], "Foreground.Opacity", name, 0.01)
 
-            if stroke_color_animation and self.is_animated(stroke_color_animation[0]):
+            if obj.stroke_color and self.is_animated(obj.stroke_color[0]):
                 name = name or self.next_text_name()
-                self.write_color_animation(stroke_color_animation[0], "(noesis:Text.Stroke).Color", name)
+                self.write_color_animation(obj.stroke_color[0], "(noesis:Text.Stroke).Color", name)
                 self.noesis_namespace = True
 
-            if stroke_opacity_animation and self.is_animated(stroke_opacity_animation[0]):
+            if obj.stroke_opacity and self.is_animated(obj.stroke_opacity[0]):
                 name = name or self.next_text_name()
-                self.write_float_animation(stroke_opacity_animation[0], "(noesis:Text.Stroke).Opacity", name, 0.01)
+                self.write_float_animation(obj.stroke_opacity[0], "(noesis:Text.Stroke).Opacity", name, 0.01)
                 self.noesis_namespace = True
 
             if name:
                 self.body += ' x:Name="%s"' % name
 
-            self.body += ' FontFamily="%s" FontSize="%d" Text="%s"' % (font.path + "#" + font.family if font.path else font.family, size, text)
-            if weight:
-                self.body += ' FontWeight="%s"' % weight
-            if style:
-                self.body += ' FontStyle="%s"' % style
+            font = k.font
+            self.body += ' FontFamily="%s" FontSize="%d" Text="%s"' % (font.path + "#" + font.family if font.path else font.family, k.size, k.text)
+            if k.weight:
+                self.body += ' FontWeight="%s"' % k.weight
+            if k.style:
+                self.body += ' FontStyle="%s"' % k.style
 
-            if color_animation or fill_color:
-                self.body += ' Foreground="#%s"' % (color_animation[0].first if color_animation else format_rgb(fill_color))
+            if obj.color or k.fill_color:
+                self.body += ' Foreground="#%s"' % (obj.color[0].first if obj.color else format_rgb(k.fill_color))
             else:
                 self.body += ' Foreground="Transparent"'
 
-            if stroke > 0.01:
+            if k.stroke > 0.01:
                 self.noesis_namespace = True
-                self.body += ' noesis:Text.StrokeThickness="%s"' % stroke
-                self.body += ' noesis:Text.Stroke="#%s"' % (stroke_color_animation[0].first if stroke_color_animation else format_rgb(stroke_color))
+                self.body += ' noesis:Text.StrokeThickness="%s"' % k.stroke
+                self.body += ' noesis:Text.Stroke="#%s"' % (obj.stroke_color[0].first if obj.stroke_color else format_rgb(k.stroke_color))
 
-            if tracking > 0:
+            if k.tracking > 0:
                 self.noesis_namespace = True
-                self.body += ' noesis:Text.CharacterSpacing="%s"' % tracking
+                self.body += ' noesis:Text.CharacterSpacing="%s"' % k.tracking
 
-            if time > 0:
+            if k.time > 0:
                 self.body += ' Visibility="Hidden"'
 
             names.append(name)
-            times.append(time)
+            times.append(k.time)
 
             self.body += '>\n'
 
             self.body += self.tab + '    <TextBlock.RenderTransform>\n'
-            self.body += self.tab + '      <TranslateTransform Y="%s"/>\n' % format_float(-baseline - baseline_shift)
+            self.body += self.tab + '      <TranslateTransform Y="%s"/>\n' % format_float(-k.baseline)
             self.body += self.tab + '    </TextBlock.RenderTransform>\n'
             self.body += self.tab + '  </TextBlock>\n'
 
         times.append(self.end)
 
-        if len(keyframes) > 1:
+        if len(obj.keyframes) > 1:
             for i in range(len(names)):
                 self.write_visibility_animations(names[i], times[i], times[i + 1])
 
-    def write_parent_layers(self, index, layers):
-        if index != None:
-            for layer in layers:
-                if layer['ind'] == index:
-                    self.write_parent_layers(layer.get('parent', None), layers)
-            self.body += self.tab + '  <Canvas RenderTransform="{Binding RenderTransform, ElementName=Layer%d}">\n' % index
+    def write_parent_layers(self, index, layers, prefix):
+        # Static ancestors are composed into a matrix that the child appends to its own transform.
+        # Animated ancestors need a binding to their RenderTransform, which already includes the
+        # static ancestors above them, so only animated ancestors generate a Canvas
+        matrix = MATRIX_IDENTITY
+        bindings = []
+        visited = set()
+
+        while index != None:
+            if index in visited:
+                self.warning("Parent layer '%d' is its own ancestor" % index)
+                break
+            visited.add(index)
+
+            layer = layers.get(index)
+            if layer is None:
+                self.warning("Parent layer '%d' not found" % index)
+                break
+
+            if self.is_transform_animated(layer.transform):
+                bindings.append(index)
+            elif not bindings:
+                matrix = mat2d_mul(matrix, self.transform_matrix(layer.transform))
+
+            index = layer.parent
+
+        for index in reversed(bindings):
+            self.body += self.tab + '  <Canvas RenderTransform="{Binding RenderTransform, ElementName=Layer%s%d}">\n' % (prefix, index)
             self.push_tab()
 
+        return matrix
+
     def find_asset(self, id):
-        for asset in self.assets:
-            if asset.id == id:
-                return asset
-        return None
+        return self.assets.get(id, None)
 
     def find_font(self, name):
-        for font in self.fonts:
-            if font.name == name:
-                return font
-        return None
+        return self.fonts.get(name, None)
+
+    def index_layers(self, layers, owner):
+        # Maps 'ind' to layer. The first layer wins in case of duplicates, like the old linear search
+        index = {}
+        for layer in layers:
+            if layer.index in index:
+                self.warning("Duplicated layer index '%d' in %s" % (layer.index, owner))
+            else:
+                index[layer.index] = layer
+        return index
+
+    def read_layers(self, layers, owner, read_layer = None):
+        # Returns the layers sorted by rendering order and their index
+        layers.sort(key = lambda layer: layer['ind'], reverse = True)
+        layers = [(read_layer or self.read_layer)(layer) for layer in layers]
+        return layers, self.index_layers(layers, owner)
 
-    def write_layer(self, obj, layers, prefix=""):
+    def read_layer(self, obj, transform = None):
+        # The transform is given when it was already read, for example from a streamed layer stub
+        self.location.append('Layer%s' % obj.get('ind'))
         self.begin_reading('layer', obj)
         unused_name = self.read_field('nm', None)
         unused_class = self.read_field('cl', None)
@@ -1506,7 +2390,8 @@ class JsonParser:
         # Common
         index = self.read_field('ind', None)
         parent = self.read_field('parent', None)
-        transform = self.read_transform(self.read_field('ks'))
+        ks = self.read_field('ks')
+        transform = transform or self.read_transform(ks)
         mask = self.read_mask(self.read_field('masksProperties', None))
         start = max(self.start, self.read_field('ip'))
         end = min(self.end, self.read_field('op'))
@@ -1528,36 +2413,56 @@ class JsonParser:
         self.end_reading()
 
         if effects != None:
-            warning('Layer Effects not supported')
+            self.warning('Layer Effects not supported')
 
         if matte_type != None:
-            warning('Track Matte not supported')
+            self.warning('Track Matte not supported')
 
         if time_stretch != 1:
-            warning('Time Stretch not supported')
+            self.warning('Time Stretch not supported')
 
         if ty > LAYER_TYPE_TEXT:
-            warning("Unsupported layer type '%d'" % ty)
+            self.warning("Unsupported layer type '%d'" % ty)
+
+        shapes = self.read_shapes(shapes) if ty == LAYER_TYPE_SHAPE else None
+        text = self.read_text(text_data) if ty == LAYER_TYPE_TEXT else None
+
+        self.location.pop()
+
+        return Layer(index, parent, transform, mask, start, end, ty, refId, \
+            solid_width, solid_height, solid_color, shapes, text)
+
+    def write_layer(self, layer, layers, prefix=""):
+        self.location.append('Layer%s%s' % (prefix, layer.index))
+        counters = (self.layer_name, self.num_paths, self.num_groups, self.num_texts)
+        self.layer_name = 'Layer%s%d' % (prefix, layer.index)
+        self.num_paths = 0
+        self.num_groups = 0
+        self.num_texts = 0
+        index = layer.index
+        transform = layer.transform
+        mask = layer.mask
+        ty = layer.ty
 
         if self.debug:
             print(' = #%s%d - %s - (%s - %s)' % \
                 (prefix, index, ['Precomp', 'Solid', 'Image', 'Null', 'Shape', 'Text'][ty], \
-                self.as_time(start), self.as_time(end)))
+                self.as_time(layer.start), self.as_time(layer.end)))
 
         start_tab = self.tab
-        name = 'Layer%s%d' % (prefix, index)
-        self.write_parent_layers(parent, layers)
+        name = self.layer_name
+        parent_matrix = self.write_parent_layers(layer.parent, layers, prefix)
 
         root_class = "Image" if ty == LAYER_TYPE_IMAGE else "Canvas"
 
         self.body += self.tab + '  <%s x:Name="%s"' % (root_class, name)
 
         if ty == LAYER_TYPE_SOLID:
-            self.body += ' Width="%d" Height="%d"' % (solid_width, solid_height)
-            self.body += ' Background="%s"' % solid_color.upper()
+            self.body += ' Width="%d" Height="%d"' % (layer.solid_width, layer.solid_height)
+            self.body += ' Background="%s"' % layer.solid_color.upper()
 
         if ty == LAYER_TYPE_IMAGE:
-            image = self.find_asset(refId)
+            image = self.find_asset(layer.ref_id)
             self.body += ' Source="%s"' % image.source
 
         if ty != LAYER_TYPE_NULL:
@@ -1565,9 +2470,9 @@ class JsonParser:
                 self.body += ' Opacity="%s"' % format_float(transform.opacity[0].first / 100.0)
             self.write_float_animation(transform.opacity[0], "Opacity", name, 0.01)
 
-        if start > 0:
+        if layer.start > 0:
             self.body += ' Visibility="Hidden"'
-        self.write_visibility_animations(name, start, end)
+        self.write_visibility_animations(name, layer.start, layer.end)
 
         if not self.has_mask_elements(mask):
             self.write_mask_attributes(mask)
@@ -1575,27 +2480,27 @@ class JsonParser:
         self.body += '>\n'
         num_lines = self.body.count('\n')
 
-        if self.has_transform_elements(transform):
-            self.write_transform_elements(root_class, transform, name)
+        if self.has_transform_elements(transform) or parent_matrix != MATRIX_IDENTITY:
+            self.write_transform_elements(root_class, transform, name, parent_matrix)
 
         if self.has_mask_elements(mask):
             self.write_mask_elements(root_class, mask, name)
 
         if ty == LAYER_TYPE_PRECOMP:
             self.push_tab()
-            asset = self.find_asset(refId)
-            for layer in asset.layers:
-                self.write_layer(copy.deepcopy(layer), asset.layers, '%s%d_' % (prefix, index))
+            asset = self.find_asset(layer.ref_id)
+            for child in asset.layers:
+                self.write_layer(child, asset.index, '%s%d_' % (prefix, index))
             self.pop_tab()
 
         if ty == LAYER_TYPE_SHAPE:
             if self.debug:
-                self.dump_shapes(shapes)
-            self.write_shapes(shapes)
+                self.dump_shapes(layer.shapes)
+            self.write_shapes(layer.shapes)
 
         if ty == LAYER_TYPE_TEXT:
             self.push_tab()
-            self.write_text(text_data)
+            self.write_text(layer.text)
             self.pop_tab()
 
         # Don't add extra line if no elements were written
@@ -1607,7 +2512,10 @@ class JsonParser:
 
         while self.tab != start_tab:
             self.pop_tab()
-            self.body += self.tab + '  </%s>\n' % root_class
+            self.body += self.tab + '  </Canvas>\n'
+
+        self.layer_name, self.num_paths, self.num_groups, self.num_texts = counters
+        self.location.pop()
 
     def read_assets(self, obj):
         if obj:
@@ -1623,15 +2531,24 @@ class JsonParser:
                 filename = self.read_field('p', "")
                 layers = self.read_field('layers', None)
 
-                if layers:
-                    for layer in layers:
-                        # Sometimes (for example in PNG Sequences) the index is missing
-                        # We always need indices as they are part of each 'x:Name'
-                        if 'ind' not in layer:
-                            layer['ind'] = layers.index(layer)
+                index = None
 
-                if layers: layers.sort(key = lambda layer: layer['ind'], reverse = True)
-                self.assets.append(Asset(id, path + filename, layers))
+                if id in self.assets:
+                    self.warning("Duplicated asset id '%s'" % id)
+                else:
+                    if layers:
+                        for i, layer in enumerate(layers):
+                            # Sometimes (for example in PNG Sequences) the index is missing
+                            # We always need indices as they are part of each 'x:Name'
+                            if 'ind' not in layer:
+                                layer['ind'] = i
+
+                        # Layers of precomps are read once, whatever the number of layers using them
+                        self.location.append(id)
+                        layers, index = self.read_layers(layers, "asset '%s'" % id)
+                        self.location.pop()
+
+                    self.assets[id] = Asset(id, path + filename, layers, index)
                 self.end_reading()
 
     def read_fonts(self, obj):
@@ -1648,11 +2565,91 @@ class JsonParser:
                 ascent = self.read_field('ascent', None)
                 fName = self.read_field('fName', None)
                 fPath = self.read_field('fPath', None)
-                self.fonts.append(Font(fName, fPath, fFamily, fStyle, ascent))
+                if fName in self.fonts:
+                    self.warning("Duplicated font name '%s'" % fName)
+                else:
+                    self.fonts[fName] = Font(fName, fPath, fFamily, fStyle, ascent)
                 self.end_reading()
             self.end_reading()
 
-    def read_composition(self, obj):
+    def read_stream(self, path):
+        # Reads the composition from a memory-mapped file without loading the whole document. Layers
+        # are decoded once to index them, keeping only what sorting and parenting need, and decoded
+        # again one at a time when they are written
+        import mmap
+
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buffer:
+            stream = JsonStream(buffer)
+            composition = {}
+            positions = {}
+
+            def read_item(layer, pos):
+                stub = dict((k, layer[k]) for k in ('ind', 'parent', 'ks') if k in layer)
+                stub['pos'] = pos
+                composition['layers'].append(stub)
+
+            def read_member(key, pos):
+                if key == 'layers':
+                    composition['layers'] = []
+                    return stream.read_array(pos, read_item)
+                composition[key], pos = stream.decode(pos)
+                return pos
+
+            def read_stub(stub):
+                self.location.append('Layer%s' % stub.get('ind'))
+                layer = Layer(stub.get('ind'), stub.get('parent', None), self.read_transform(stub['ks']))
+                self.location.pop()
+                positions[id(layer)] = stub['pos']
+                return layer
+
+            def load_layer(layer):
+                return self.read_layer(stream.decode(positions[id(layer)])[0], layer.transform)
+
+            stream.read_object(0, read_member)
+            self.write_composition(self.read_composition(composition, read_stub), load_layer)
+
+    def read_file(self, path):
+        # Reads the composition of a JSON file. With a cache directory, the normalised composition
+        # is stored there keyed by the hash of the file and the reader version, so later conversions
+        # of the same file (with any options) skip parsing and reading
+        start = time.time()
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        cache_file = None
+        if self.cache:
+            import hashlib
+            import os
+            cache_file = os.path.join(self.cache, '%s.%d.cache' % (hashlib.sha256(data).hexdigest(), READER_VERSION))
+            cached = load_cache(cache_file)
+            if cached is not None:
+                composition = cached[0]
+                self.diagnostics.merge(Diagnostics(cached[1]))
+                self.timings['cache'] = time.time() - start
+                return composition
+
+        obj = load_json(data, self.json_backend)
+        self.timings['parse'] = time.time() - start
+
+        # Warnings of the reading are stored along the composition, they are reported on cache hits too
+        start = time.time()
+        outer = self.diagnostics
+        self.diagnostics = Diagnostics()
+        try:
+            composition = self.read_composition(obj)
+        finally:
+            diagnostics = self.diagnostics
+            self.diagnostics = outer
+            outer.merge(diagnostics)
+        self.timings['read'] = time.time() - start
+
+        if cache_file:
+            save_cache(cache_file, composition, diagnostics.warnings)
+
+        return composition
+
+    def read_composition(self, obj, read_layer = None):
+        # Returns the normalised Composition, the JSON objects are consumed while reading
         self.begin_reading('composition', obj)
         name = self.read_field('nm', "")
         version = self.read_field('v')
@@ -1663,37 +2660,1243 @@ class JsonParser:
         self.fps = self.read_field('fr')
         layers = self.read_field('layers')
         unused_is_3d = self.read_field('ddd')
-        unused_markers = self.read_field('markers', None)
-        self.read_assets(self.read_field('assets', None))
+        markers = self.read_markers(self.read_field('markers', None))
+        # Fonts are needed by the text layers of the assets
         self.read_fonts(self.read_field('fonts', None))
+        self.read_assets(self.read_field('assets', None))
         unused_chars = self.read_field('chars', None)
         self.end_reading()
 
         if self.start != 0:
-            warning('Composition start is not at zero')
+            self.warning('Composition start is not at zero')
 
-        secs = format_float((self.end - self.start) / float(self.fps))
-        print('= %s - %d x %d @%d - %s secs - BodyMovin v%s' % (name, self.width, self.height, self.fps, secs, version))
+        layers, index = self.read_layers(layers, 'composition', read_layer)
 
-        # Sort layers by rendering order
-        layers.sort(key = lambda layer: layer['ind'], reverse = True)
+        return Composition(name, version, self.width, self.height, self.start, self.end, self.fps, layers, index, self.assets, markers)
 
+    def read_markers(self, obj):
+        markers = []
+        if obj:
+            for marker in obj:
+                self.begin_reading('marker', marker)
+                name = self.read_field('cm', '')
+                time = self.read_field('tm')
+                duration = self.read_field('dr', 0)
+                self.end_reading()
+                markers.append(Marker(name, time, duration))
+        return markers
+
+    def use_composition(self, composition):
+        self.name = composition.name
+        self.version = composition.version
+        self.width = composition.width
+        self.height = composition.height
+        self.start = composition.start
+        self.end = composition.end
+        self.fps = composition.fps
+        self.assets = composition.assets
+        self.time_strings = {}
+        self.keyframe_prefixes = {}
+        self.clipped_keys = {}
+        self.asset_digests = {}
+        self.segments = self.find_segments(composition.markers) if self.markers else None
+        self.segment_animations = [''] * len(self.segments or [])
+
+    def find_segments(self, markers):
+        # Returns the (key, start, end) of the storyboard of each marker, markers without duration
+        # last until the next one. None when there are no usable markers
+        segments = []
+        keys = set()
+        markers = sorted(markers, key = lambda marker: marker.time)
+        for i, marker in enumerate(markers):
+            key = marker.name or 'Marker%d' % i
+            if marker.duration > 0:
+                end = marker.time + marker.duration
+            else:
+                end = next((m.time for m in markers[i + 1:] if m.time > marker.time), self.end)
+            start = max(marker.time, self.start)
+            end = min(end, self.end)
+
+            if key in keys:
+                self.warning("Duplicated marker '%s'" % key)
+            elif start >= end:
+                self.warning("Marker '%s' is empty or out of the composition" % key)
+            else:
+                keys.add(key)
+                segments.append((key, start, end))
+
+        if not segments:
+            self.warning('No markers found, the animation is written as a single storyboard')
+            return None
+        return segments
+
+    def frame_range(self, composition):
+        # Frames to convert, either end of the 'frames' option can be None
+        start = max(self.frames[0] if self.frames[0] is not None else composition.start, composition.start)
+        end = min(self.frames[1] if self.frames[1] is not None else composition.end, composition.end)
+        if start >= end:
+            self.error('Frame range out of the composition')
+        return start, end
+
+    def clip_composition(self, composition, start, end):
+        # Returns the composition between two frames, re-based to the first one. Layers out of the
+        # range are dropped, unless they are parents of others as their elements may be bound to.
+        # Values at the start become the base values and the animations that are constant in the
+        # range are removed
+        def clip_layers(layers, index):
+            parents = find_parents(layers, index)
+            clipped_index = dict((i, self.clip_layer(layer, start, end)) for i, layer in index.items())
+            clipped = []
+            for layer in layers:
+                if layer.start is None:
+                    # Layers read when streaming are stubs, loaded and clipped when they are written
+                    clipped.append(layer)
+                elif layer.start < end and layer.end > start or layer.index in parents:
+                    clipped.append(clipped_index[layer.index] if index.get(layer.index) is layer else self.clip_layer(layer, start, end))
+            return clipped, clipped_index
+
+        assets = {}
+        for id, asset in composition.assets.items():
+            layers, index = clip_layers(asset.layers, asset.index) if asset.layers else (asset.layers, asset.index)
+            assets[id] = Asset(asset.id, asset.source, layers, index)
+
+        layers, index = clip_layers(composition.layers, composition.index)
+
+        markers = []
+        for i, marker in enumerate(composition.markers):
+            if marker.duration > 0:
+                if marker.time < end and marker.time + marker.duration > start:
+                    markers.append(Marker(marker.name, max(marker.time, start) - start, \
+                        min(marker.time + marker.duration, end) - max(marker.time, start)))
+            elif marker.time < end and not any(m.duration <= 0 and marker.time < m.time <= start for m in composition.markers):
+                markers.append(Marker(marker.name, max(marker.time, start) - start, 0))
+
+        return composition._replace(start = 0, end = end - start, layers = layers, index = index, assets = assets, markers = markers)
+
+    def clip_layer(self, layer, start, end):
+        # Layers out of the range are hidden
+        if layer.start is None:
+            return layer._replace(transform = self.clip_value(layer.transform, start, end))
+        if layer.start >= end or layer.end <= start:
+            layer = layer._replace(start = start, end = start)
+
+        text = layer.text
+        if text is not None:
+            # The text shown at the start is kept from the start
+            keyframes = [k for k in text.keyframes if k.time < end and not any(start >= o.time > k.time for o in text.keyframes)]
+            text = self.clip_value(text._replace(keyframes = [k._replace(time = max(k.time - start, 0)) for k in keyframes]), start, end)
+
+        return layer._replace(transform = self.clip_value(layer.transform, start, end), mask = self.clip_value(layer.mask, start, end), \
+            shapes = self.clip_value(layer.shapes, start, end), text = text, \
+            start = min(max(layer.start, start), end) - start, end = max(min(layer.end, end), start) - start)
+
+    def clip_value(self, value, start, end):
+        # Clips the animations found in a value of the model
+        if isinstance(value, Animation):
+            if value.keyframes is None:
+                return value
+            track = self.clip_track(value.keyframes, start, end)
+            return Animation(track.value(0), None if track.is_constant() else track)
+
+        if isinstance(value, Geometry):
+            if value.channels is None:
+                return value
+            channels = self.clip_value(value.channels, start, end)
+            animated = any(self.is_animated(v) for v in channels)
+            return Geometry(channels, None if animated else self.format_path_data(channels), animated)
+
+        if isinstance(value, list):
+            return [self.clip_value(v, start, end) for v in value]
+
+        if isinstance(value, tuple) and hasattr(value, '_fields') and not isinstance(value, (Font, TextKeyframe)):
+            return type(value)(*[self.clip_value(v, start, end) for v in value])
+
+        return value
+
+    def reduce_composition(self, composition, tier):
+        # Returns the composition with the reductions of a level of detail tier applied. Sizes are
+        # measured in pixels of the composition, so the contents of precomps are scaled by the
+        # largest scale of the layers using them
+        scales = {}
+
+        def find_scales(layers, index, scale):
+            for layer in layers:
+                if layer.ty == LAYER_TYPE_PRECOMP:
+                    asset = composition.assets.get(layer.ref_id)
+                    owner_scale = scale * self.layer_scale(layer, index)
+                    if asset is not None and asset.layers and owner_scale > scales.get(layer.ref_id, -1):
+                        scales[layer.ref_id] = owner_scale
+                        find_scales(asset.layers, asset.index, owner_scale)
+
+        def reduce_layers(layers, index, scale):
+            parents = find_parents(layers, index)
+            reduced_index = dict((i, self.reduce_layer(layer, index, tier, scale)) for i, layer in index.items())
+            reduced = []
+            for layer in layers:
+                # Invisible layers are culled unless their transforms are bound by other layers
+                if layer.ty != LAYER_TYPE_NULL and layer.index not in parents and max_value(layer.transform.opacity) < tier.min_opacity:
+                    continue
+                reduced.append(reduced_index[layer.index] if index.get(layer.index) is layer else self.reduce_layer(layer, index, tier, scale))
+            return reduced, reduced_index
+
+        find_scales(composition.layers, composition.index, 1.0)
+
+        assets = {}
+        for id, asset in composition.assets.items():
+            layers, index = reduce_layers(asset.layers, asset.index, scales.get(id, 1.0)) if asset.layers else (asset.layers, asset.index)
+            assets[id] = Asset(asset.id, asset.source, layers, index)
+
+        layers, index = reduce_layers(composition.layers, composition.index, 1.0)
+        return composition._replace(layers = layers, index = index, assets = assets)
+
+    def layer_scale(self, layer, index):
+        # Largest scale of a layer and its parents, as a factor
+        scale = max_value(layer.transform.scale) / 100.0
+        visited = set()
+        parent = layer.parent
+        while parent is not None and parent not in visited and parent in index:
+            visited.add(parent)
+            scale *= max_value(index[parent].transform.scale) / 100.0
+            parent = index[parent].parent
+        return scale
+
+    def reduce_layer(self, layer, index, tier, scale):
+        mask = [self.reduce_value(path, tier, True) for path in layer.mask] if layer.mask else layer.mask
+        shapes = self.reduce_shapes(layer.shapes, tier, scale * self.layer_scale(layer, index)) if layer.shapes else layer.shapes
+        return layer._replace(transform = self.reduce_value(layer.transform, tier), mask = mask, shapes = shapes, \
+            text = self.reduce_value(layer.text, tier))
+
+    def reduce_shapes(self, shapes, tier, scale):
+        # Culls groups and paints that are never visible and paths smaller than the minimum size,
+        # including the width of the strokes applied to them
+        transform = next((shape.value for shape in shapes if self.is_transform_attr(shape.ty)), None)
+        if transform is not None:
+            scale *= max_value(transform.scale) / 100.0
+        stroke = max([max_value(shape.value.stroke.width) for shape in shapes \
+            if self.is_paint_attr(shape.ty) and shape.value is not None and shape.value.stroke] + [0])
+
+        reduced = []
+        for shape in shapes:
+            value = shape.value
+            if self.is_group_attr(shape.ty):
+                group_transform = next((s.value for s in value if self.is_transform_attr(s.ty)), None)
+                if group_transform is not None and max_value(group_transform.opacity) < tier.min_opacity:
+                    continue
+                value = self.reduce_shapes(value, tier, scale)
+            elif self.is_paint_attr(shape.ty) and value is not None:
+                if max_value((value.fill or value.stroke).opacity) < tier.min_opacity:
+                    continue
+                value = self.reduce_value(value, tier)
+            elif self.is_path_attr(shape.ty) and value is not None:
+                if not value.animated and (path_size(value) + stroke) * scale < tier.min_size:
+                    continue
+                value = self.reduce_value(value, tier)
+            else:
+                value = self.reduce_value(value, tier)
+            reduced.append(Shape(shape.ty, shape.name, value))
+        return reduced
+
+    def reduce_value(self, value, tier, coordinates = False):
+        # Reduces the keyframes of the animations found in a value of the model. Coordinates (of
+        # positions, anchors, paths and gradients) are also rounded and static paths simplified
+        if isinstance(value, list) and value and isinstance(value[0], Animation):
+            value = reduce_animations(value, tier.tolerance)
+            return [round_animation(a, tier.decimals) for a in value] if coordinates else value
+
+        if isinstance(value, Geometry):
+            if value.channels is None:
+                return Geometry(None, PATH_DATA_NUMBER.sub(lambda m: format_float(round(float(m.group()), tier.decimals)), value.data), False)
+            channels = self.reduce_value(value.channels, tier, True)
+            animated = any(self.is_animated(v) for v in channels)
+            if animated:
+                return Geometry(channels, None, True)
+            channels = [Animation(p, None) for p in simplify_path([c.first for c in channels], tier.path_tolerance)]
+            return Geometry(channels, self.format_path_data(channels), False)
+
+        if isinstance(value, Transform):
+            return Transform(self.reduce_value(value.anchor, tier, True), self.reduce_value(value.position, tier, True), \
+                self.reduce_value(value.scale, tier), self.reduce_value(value.rotation, tier), self.reduce_value(value.opacity, tier))
+
+        if isinstance(value, Gradient):
+            return value._replace(start = self.reduce_value(value.start, tier, True), end = self.reduce_value(value.end, tier, True), \
+                length = self.reduce_value(value.length, tier), angle = self.reduce_value(value.angle, tier))
+
+        if isinstance(value, list):
+            return [self.reduce_value(v, tier, coordinates) for v in value]
+
+        if isinstance(value, tuple) and hasattr(value, '_fields') and not isinstance(value, (Font, TextKeyframe)):
+            return type(value)(*[self.reduce_value(v, tier) for v in value])
+
+        return value
+
+    def resample_composition(self, composition, step):
+        # Returns the composition with its dense linear animations resampled to one keyframe every
+        # 'step' frames. Layers shared by the list and the index are resampled once, stubs read when
+        # streaming are kept as they are, they are resampled when loaded
+        def resample_layers(layers, index):
+            resampled = dict((i, self.resample_value(layer, step)) for i, layer in index.items())
+            return [layer if layer.start is None else resampled[layer.index] if index.get(layer.index) is layer else \
+                self.resample_value(layer, step) for layer in layers], resampled
+
+        assets = {}
+        for id, asset in composition.assets.items():
+            layers, index = resample_layers(asset.layers, asset.index) if asset.layers else (asset.layers, asset.index)
+            assets[id] = Asset(asset.id, asset.source, layers, index)
+
+        layers, index = resample_layers(composition.layers, composition.index)
+        return composition._replace(layers = layers, index = index, assets = assets)
+
+    def resample_value(self, value, step):
+        # Resamples the animations found in a value of the model. When measuring the error, the
+        # resampled animations are compared with their sources
+        if isinstance(value, list) and value and isinstance(value[0], Animation):
+            resampled = resample_animations(value, step)
+            if self.emitted is not None:
+                for a, b in zip(value, resampled):
+                    if a is not b:
+                        self.sources[id(b)] = a
+            return resampled
+
+        if isinstance(value, list):
+            return [self.resample_value(v, step) for v in value]
+
+        if isinstance(value, tuple) and hasattr(value, '_fields') and not isinstance(value, (Font, TextKeyframe)):
+            return type(value)(*[self.resample_value(v, step) for v in value])
+
+        return value
+
+    def write_composition(self, composition, load_layer = None):
+        # Layers can be loaded lazily by 'load_layer', for example when streaming
+        if self.frames:
+            start, end = self.frame_range(composition)
+            if load_layer:
+                parents = find_parents(composition.layers, composition.index)
+                def load_layer(layer, load = load_layer, source = composition):
+                    # Layers are read with the timing of the source, which clamps their range
+                    timing = (self.start, self.end)
+                    self.start, self.end = source.start, source.end
+                    try:
+                        layer = load(layer)
+                    finally:
+                        self.start, self.end = timing
+                    if layer.start < end and layer.end > start or layer.index in parents:
+                        return self.clip_layer(layer, start, end)
+                    return None
+            composition = self.clip_composition(composition, start, end)
+
+        if self.max_keyframe_rate and self.max_keyframe_rate < composition.fps:
+            step = composition.fps / float(self.max_keyframe_rate)
+            if load_layer:
+                def load_layer(layer, load = load_layer):
+                    layer = load(layer)
+                    return self.resample_value(layer, step) if layer is not None else None
+            composition = self.resample_composition(composition, step)
+
+        self.use_composition(composition)
+
+        if self.verbose:
+            secs = format_float((self.end - self.start) / float(self.fps))
+            print('= %s - %d x %d @%d - %s secs - BodyMovin v%s' % (self.name, self.width, self.height, self.fps, secs, self.version))
+
+        if load_layer:
+            # Only the fragments are kept, each layer is released once written
+            layers = []
+            fragments = []
+            for stub in composition.layers:
+                layer = load_layer(stub)
+                if layer is not None:
+                    layers.append(stub)
+                    fragments.append(self.write_fragment(layer, composition.index))
+            self.merge_fragments(layers, fragments, composition.index)
+            return
+
+        # Each top-level layer is written as a fragment, reused from the cache when the layer and
+        # everything it depends on did not change
+        fragments = [None] * len(composition.layers)
+        paths = [None] * len(composition.layers)
+
+        if self.cache:
+            import os
+            for i, layer in enumerate(composition.layers):
+                paths[i] = os.path.join(self.cache, '%s.fragment' % self.fragment_key(composition, layer))
+                fragments[i] = load_fragment(paths[i])
+
+        missing = [i for i in range(len(fragments)) if fragments[i] is None]
+
+        # Debug information is printed while writing, so it is only readable when writing serially
+        if self.jobs and self.jobs > 1 and len(missing) > 1 and not self.debug:
+            written = self.write_fragments_parallel(composition, missing)
+        else:
+            written = [self.write_fragment(composition.layers[i], composition.index) for i in missing]
+
+        for i, fragment in zip(missing, written):
+            fragments[i] = fragment
+            if paths[i]:
+                os.makedirs(self.cache, exist_ok = True)
+                save_fragment(paths[i], fragment)
+
+        self.merge_fragments(composition.layers, fragments, composition.index)
+
+    def merge_fragments(self, layers, fragments, index):
+        # Concatenates the fragments of the top-level layers. When grouping static content, runs of
+        # consecutive layers that never change (no timelines and no animated ancestors) are wrapped
+        # in a container the application can cache. Layers are not reordered, as that would change
+        # the stacking of static layers drawn over animated ones
+        groups = 0
+        grouped = False
+        self.costs = []
+
+        for layer, (body, animations, segment_animations, noesis_namespace, warnings) in zip(layers, fragments):
+            self.costs.append(('Layer%d' % layer.index, estimate_fragment_cost(body, animations)))
+            static = self.group_static and not animations and not self.has_animated_ancestors(layer, index)
+            if static and not grouped:
+                self.body += '  <Canvas x:Name="Static%d" Tag="Static">\n' % groups
+                groups += 1
+                grouped = True
+            elif grouped and not static:
+                self.body += '  </Canvas>\n'
+                grouped = False
+
+            self.body += indent(body, '  ') if static else body
+            self.animations += animations
+            self.segment_animations = [a + b for a, b in zip(self.segment_animations, segment_animations)]
+            self.noesis_namespace = self.noesis_namespace or noesis_namespace
+            self.diagnostics.merge(Diagnostics(warnings))
+
+        if grouped:
+            self.body += '  </Canvas>\n'
+
+    def has_animated_ancestors(self, layer, index):
+        # Elements of layers with animated ancestors are bound to their transforms
+        visited = set()
+        parent = layer.parent
+        while parent is not None and parent not in visited and parent in index:
+            visited.add(parent)
+            if self.is_transform_animated(index[parent].transform):
+                return True
+            parent = index[parent].parent
+        return False
+
+    def write_fragment(self, layer, index):
+        # Writes a top-level layer on its own, returns its body and storyboard fragments, whether
+        # it needs the noesis namespace and its warnings
+        state = (self.body, self.animations, self.segment_animations, self.noesis_namespace, self.diagnostics)
+        self.body = ''
+        self.animations = ''
+        self.segment_animations = [''] * len(self.segment_animations)
+        self.noesis_namespace = False
+        self.diagnostics = Diagnostics()
+        try:
+            self.write_layer(layer, index)
+            return (self.body, self.animations, self.segment_animations, self.noesis_namespace, self.diagnostics.warnings)
+        finally:
+            self.body, self.animations, self.segment_animations, self.noesis_namespace, self.diagnostics = state
+
+    def write_fragments_parallel(self, composition, indices):
+        # Top-level layers (with their precomps) are written by worker processes, each receiving
+        # the composition once. Fragments are returned in the given order
+        import concurrent.futures
+
+        jobs = min(self.jobs, len(indices))
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer = init_layer_worker, initargs = (composition, self.markers)) as pool:
+            chunksize = max(1, len(indices) // (jobs * 4))
+            return list(pool.map(write_layer_fragment, indices, chunksize = chunksize))
+
+    def fragment_key(self, composition, layer):
+        # Hash of everything the XAML of a top-level layer depends on: the layer, the transforms of
+        # its parents, the assets it references, the timing of the composition and its segments
+        import hashlib
+        import pickle
+
+        digest = hashlib.sha256()
+        digest.update(pickle.dumps((WRITER_VERSION, READER_VERSION, composition.start, composition.end, composition.fps, self.segments, layer), 4))
+
+        index = layer.parent
+        visited = set()
+        while index is not None and index not in visited and index in composition.index:
+            visited.add(index)
+            parent = composition.index[index]
+            digest.update(pickle.dumps((parent.index, parent.parent, parent.transform), 4))
+            index = parent.parent
+
+        for id in self.referenced_assets([layer], set()):
+            digest.update(self.asset_digest(id))
+
+        return digest.hexdigest()
+
+    def referenced_assets(self, layers, found):
+        # Ids of the assets used by the layers, including the ones used by nested precomps
         for layer in layers:
-            self.write_layer(copy.deepcopy(layer), layers)
+            if layer.ref_id is not None and layer.ref_id not in found:
+                found.add(layer.ref_id)
+                asset = self.find_asset(layer.ref_id)
+                if asset is not None and asset.layers:
+                    self.referenced_assets(asset.layers, found)
+        return sorted(found, key = str)
+
+    def asset_digest(self, id):
+        digest = self.asset_digests.get(id)
+        if digest is None:
+            import hashlib
+            import pickle
+            digest = hashlib.sha256(pickle.dumps((id, self.find_asset(id)), 4)).digest()
+            self.asset_digests[id] = digest
+        return digest
+
+def find_parents(layers, index):
+    # Indices of the ancestors of the given layers
+    parents = set()
+    for layer in layers:
+        parent = layer.parent
+        while parent is not None and parent not in parents and parent in index:
+            parents.add(parent)
+            parent = index[parent].parent
+    return parents
+
+# Composition given to the processes writing layers in parallel
+layer_workers = []
+
+def init_layer_worker(composition, markers):
+    parser = JsonParser(markers = markers)
+    parser.use_composition(composition)
+    layer_workers[:] = [(parser, composition)]
+
+def write_layer_fragment(i):
+    parser, composition = layer_workers[0]
+    return parser.write_fragment(composition.layers[i], composition.index)
+
+# Reference evaluator. Samples the read animations, with the Bodymovin semantic, and the keyframes
+# of the generated XAML, with the XAML semantic, to measure the error introduced by the conversion
+# and by lossy optimisations
+
+def spline_parameter(easing, x):
+    # Parameter of a KeySpline (cubic Bezier from (0,0) to (1,1)) at the given time progress. A few
+    # Newton iterations converge for most curves, bisection is the fallback for flat slopes
+    (x1, y1), (x2, y2) = easing
+    ax = 1 + 3 * x1 - 3 * x2
+    bx = 3 * x2 - 6 * x1
+    cx = 3 * x1
+    s = x
+    for i in range(8):
+        error = ((ax * s + bx) * s + cx) * s - x
+        if abs(error) < 1e-7:
+            break
+        slope = (3 * ax * s + 2 * bx) * s + cx
+        if abs(slope) < 1e-6:
+            break
+        s -= error / slope
+    if not 0 <= s <= 1 or abs(((ax * s + bx) * s + cx) * s - x) >= 1e-7:
+        lo = 0.0
+        hi = 1.0
+        for i in range(40):
+            s = (lo + hi) * 0.5
+            if ((ax * s + bx) * s + cx) * s < x:
+                lo = s
+            else:
+                hi = s
+        s = (lo + hi) * 0.5
+    return s
+
+def solve_spline(easing, x):
+    # Progress of a KeySpline at the given time progress
+    (x1, y1), (x2, y2) = easing
+    s = spline_parameter(easing, x)
+    return 3 * (1 - s) * (1 - s) * s * y1 + 3 * (1 - s) * s * s * y2 + s * s * s
+
+def ease(easing, progress):
+    if easing == EASING_LINEAR:
+        return progress
+    return solve_spline(easing, progress)
+
+def as_vector(value):
+    # Numbers, points and '#AARRGGBB' colors as tuples of floats
+    if isinstance(value, str):
+        value = value.lstrip('#')
+        return tuple(float(int(value[i:i + 2], 16)) for i in range(0, len(value), 2))
+    if isinstance(value, (list, tuple)):
+        return tuple(float(v) for v in value)
+    return (float(value),)
+
+def find_segment(times, frame):
+    # Index of the keyframe ending the segment that contains the frame, 0 before the first one and
+    # len(times) after the last one
+    return bisect.bisect_right(times, frame)
+
+def spatial_point(p0, p1, p2, p3, progress, samples = 32):
+    # Point at the given fraction of the length of a cubic Bezier, like motion paths in After Effects
+    def at(s):
+        return tuple((1 - s) ** 3 * a + 3 * (1 - s) ** 2 * s * b + 3 * (1 - s) * s * s * c + s ** 3 * d \
+            for a, b, c, d in zip(p0, p1, p2, p3))
+
+    points = [at(i / float(samples)) for i in range(samples + 1)]
+    lengths = [0.0]
+    for i in range(samples):
+        lengths.append(lengths[-1] + math.sqrt(sum((b - a) ** 2 for a, b in zip(points[i], points[i + 1]))))
+
+    if lengths[-1] == 0:
+        return at(progress)
+
+    target = progress * lengths[-1]
+    i = min(max(bisect.bisect_left(lengths, target), 1), samples)
+    t = (target - lengths[i - 1]) / (lengths[i] - lengths[i - 1]) if lengths[i] > lengths[i - 1] else 0.0
+    return at((i - 1 + t) / float(samples))
+
+def evaluate_source(channels, frame):
+    # Values of the channels of a property at the given frame. Channels are Animations sharing
+    # their keyframe times (a Track dimension each). Segments with 'to'/'ti' tangents follow a
+    # spatial Bezier through all the given dimensions, missing dimensions are assumed static
+    track = channels[0].keyframes
+    keys = track.keys
+    i = find_segment(keys.times, frame)
+    if i == 0:
+        return [as_vector(c.keyframes.value(0)) for c in channels]
+    if i == len(keys.times):
+        return [as_vector(c.keyframes.value(i - 1)) for c in channels]
+
+    starts = [as_vector(c.keyframes.value(i - 1)) for c in channels]
+    ends = [as_vector(c.keyframes.value(i)) for c in channels]
+    easing = keys.easings[i]
+    if easing == EASING_DISCRETE:
+        return starts
+
+    progress = ease(easing, (frame - keys.times[i - 1]) / (keys.times[i] - keys.times[i - 1]))
+    to = keys.to[i]
+    ti = keys.ti[i]
+
+    if to is not None and ti is not None and all(len(v) == 1 for v in starts + ends):
+        dims = [c.keyframes.dim for c in channels]
+        if any(to[d] != 0 or ti[d] != 0 for d in dims):
+            p0 = tuple(v[0] for v in starts)
+            p3 = tuple(v[0] for v in ends)
+            p1 = tuple(v + to[d] for v, d in zip(p0, dims))
+            p2 = tuple(v + ti[d] for v, d in zip(p3, dims))
+            return [(v,) for v in spatial_point(p0, p1, p2, p3, progress)]
+
+    return [tuple(a + (b - a) * progress for a, b in zip(start, end)) for start, end in zip(starts, ends)]
+
+def parse_key_time(text, fps):
+    h, m, s = text.split(':')
+    return (float(h) * 3600.0 + float(m) * 60.0 + float(s)) * fps
+
+def parse_storyboard(xaml, fps):
+    # Returns the keyframes of each (target, property) animated by the XAML as lists of
+    # (frame, value, easing), with frames computed from the KeyTime strings as written
+    import xml.etree.ElementTree as ElementTree
+
+    animations = {}
+    for element in ElementTree.fromstring(xaml).iter():
+        tag = element.tag.rsplit('}', 1)[-1]
+        if not tag.endswith('AnimationUsingKeyFrames') or tag.startswith('Object'):
+            continue
+
+        keyframes = []
+        for keyframe in element:
+            kind = keyframe.tag.rsplit('}', 1)[-1]
+            spline = keyframe.get('KeySpline')
+            if kind.startswith('Discrete'):
+                easing = EASING_DISCRETE
+            elif spline:
+                easing = tuple(tuple(float(v) for v in point.split(',')) for point in spline.split(' '))
+            else:
+                easing = EASING_LINEAR
+            value = keyframe.get('Value')
+            value = as_vector(value) if value.startswith('#') else tuple(float(v) for v in value.split(','))
+            keyframes.append((parse_key_time(keyframe.get('KeyTime'), fps), value, easing))
+
+        animations[(element.get('Storyboard.TargetName'), element.get('Storyboard.TargetProperty'))] = keyframes
+
+    return animations
+
+def evaluate_xaml(keyframes, base, frame):
+    # Value of XAML keyframes at the given frame, starting from the base value of the property
+    times = [k[0] for k in keyframes]
+    i = find_segment(times, frame)
+    if i == len(keyframes):
+        return keyframes[-1][1]
+
+    start_time, start_value = (times[i - 1], keyframes[i - 1][1]) if i > 0 else (0.0, base)
+    end_time, end_value, easing = keyframes[i]
+    if easing == EASING_DISCRETE or end_time <= start_time:
+        return start_value if frame < end_time else end_value
+
+    progress = ease(easing, (frame - start_time) / (end_time - start_time))
+    return tuple(a + (b - a) * progress for a, b in zip(start_value, end_value))
+
+def compare_animations(parser, xaml, step = 1.0):
+    # Maximum deviation of every animation written by the parser (recorded in 'emitted') between
+    # its source and the XAML, sampled every 'step' frames and at every keyframe. Errors are in
+    # source units: distances for points and 0-255 components for colors
+    storyboard = parse_storyboard(xaml, parser.fps)
+
+    # Dimensions of the same property share their keyframe times, they are evaluated together
+    # for spatial interpolation. Precomps written several times record the same channels again
+    siblings = {}
+    for name, property, obj, scale, offset in parser.emitted:
+        channels = siblings.setdefault(id(obj.keyframes.keys), [])
+        if not any(c is obj for c in channels):
+            channels.append(obj)
+
+    frames = set()
+    frame = float(parser.start)
+    while frame <= parser.end:
+        frames.add(frame)
+        frame += step
+
+    errors = []
+    for name, property, obj, scale, offset in parser.emitted:
+        keyframes = storyboard.get((name, property))
+        if keyframes is None:
+            continue
+
+        # Siblings are only needed by spatial segments, paths share their keys with all their vertices
+        keys = obj.keyframes.keys
+        channels = siblings[id(keys)] if any(to is not None for to in keys.to) else [obj]
+        index = next(i for i, c in enumerate(channels) if c is obj)
+        base = tuple(v * scale + offset for v in as_vector(obj.first))
+        samples = sorted(frames.union(obj.keyframes.keys.times).union(k[0] for k in keyframes))
+
+        max_error = 0.0
+        max_frame = samples[0] if samples else parser.start
+        for frame in samples:
+            source = evaluate_source(channels, frame)[index]
+            target = evaluate_xaml(keyframes, base, frame)
+            target = tuple((v - offset) / scale for v in target) if len(target) == 1 else target
+            error = math.sqrt(sum((a - b) ** 2 for a, b in zip(source, target))) if len(source) > 1 and len(source) < 4 \
+                else max(abs(a - b) for a, b in zip(source, target))
+            if error > max_error:
+                max_error = error
+                max_frame = frame
+
+        errors.append(ChannelError(name, property, max_error, max_frame))
+
+    errors.sort(key = lambda e: e.max_error, reverse = True)
+    return errors
+
+def measure_error(data, step = 1.0, **options):
+    # Converts the animation (same arguments as convert()) and returns a ChannelError for each
+    # animated property, sorted from the largest error. Layers are always written serially and
+    # without the cache, as the sources of the animations are recorded while writing, and the
+    # whole animation is compared as a single storyboard
+    data = load_document(data, options.get('json_backend', None))
+
+    options = dict(options, jobs = None, cache = None, markers = False)
+    parser = JsonParser(**options)
+    parser.emitted = []
+    parser.write_composition(parser.read_composition(data))
+    f = io.StringIO()
+    parser.write_document(f)
+    return compare_animations(parser, f.getvalue(), step)
+
+# Runtime cost estimation. Counted from the XAML written for each top-level layer (including its
+# precomps), so it is also available for fragments written in parallel or reused from the cache
+
+COST_ELEMENTS = re.compile(r'<(?:Canvas|Path|TextBlock|Image)(?![.\w])')
+COST_TIMELINES = re.compile(r'<\w+AnimationUsingKeyFrames ')
+COST_POINTS = re.compile(r'<PointAnimationUsingKeyFrames Storyboard.TargetProperty="(?:Data|Clip)\.Figures')
+COST_CLIPS = re.compile(r' Clip="|<\w+\.Clip>')
+COST_GRADIENTS = re.compile(r'<(?:Linear|Radial)GradientBrush(?![.\w])')
+COST_TEXTS = re.compile(r'<TextBlock(?![.\w])')
+
+def estimate_fragment_cost(body, animations):
+    # Visual elements, timelines and their keyframes in the storyboard, animated path points (each
+    # one rebuilds its geometry every frame), clips, gradient brushes and text elements
+    return Cost(len(COST_ELEMENTS.findall(body)), len(COST_TIMELINES.findall(animations)), animations.count('KeyTime="'),
+        len(COST_POINTS.findall(animations)), len(COST_CLIPS.findall(body)), len(COST_GRADIENTS.findall(body)), len(COST_TEXTS.findall(body)))
+
+def total_cost(costs):
+    return Cost(*[sum(values) for values in zip(*[cost for name, cost in costs])]) if costs else Cost(*[0] * len(Cost._fields))
+
+def estimate_cost(data, **options):
+    # Converts the animation (same arguments as convert()) and returns the (layer name, Cost) of
+    # each top-level layer. Timelines are counted in the storyboard of the whole animation
+    data = load_document(data, options.get('json_backend', None))
+
+    parser = JsonParser(**options)
+    parser.write_composition(parser.read_composition(data))
+    return parser.costs
+
+def parse_budget(spec):
+    # Budgets are given as '<name>=<limit>[,...]' with the names of the Cost fields, for example
+    # 'elements=500,keyframes=5000'
+    budget = {}
+    for item in spec.split(','):
+        name, _, limit = item.partition('=')
+        name = name.strip()
+        if name not in Cost._fields:
+            raise ValueError("Unknown budget '%s', expected one of %s" % (name, ', '.join(Cost._fields)))
+        try:
+            budget[name] = int(limit)
+        except ValueError:
+            raise ValueError("Invalid budget limit '%s' for '%s'" % (limit, name))
+    return budget
+
+def check_budget(costs, budget):
+    # Returns the (name, total, limit) of the budgets exceeded by the total cost
+    total = total_cost(costs)
+    return [(name, getattr(total, name), limit) for name, limit in budget.items() if getattr(total, name) > limit]
+
+# Seconds between checks of the watched files, and without changes before converting again
+WATCH_INTERVAL = 0.2
+WATCH_DEBOUNCE = 0.3
+
+# Options of each output variant
+VARIANT_OPTIONS = ('viewbox', 'template', 'repeat')
+# Options accepted by jobs of the conversion service, the JsonParser arguments that don't write to
+# the console or start processes of their own
+SERVICE_OPTIONS = VARIANT_OPTIONS + ('json_backend', 'cache', 'markers', 'frames', 'group_static', 'max_keyframe_rate')
+
+def as_variant(obj):
+    return Variant(obj.get('viewbox', False), obj.get('template', None), obj.get('repeat', None))
+
+def parse_variant(spec):
+    # Command line variants are given as '<file>[,<option>...]', for example 'out.xaml,viewbox' or
+    # 'out.xaml,template=lottie,repeat=Forever'
+    items = spec.split(',')
+    variant = {}
+    for item in items[1:]:
+        key, _, value = item.partition('=')
+        if key not in VARIANT_OPTIONS:
+            raise ValueError("Unknown variant option '%s'" % key)
+        if not value and key != 'viewbox':
+            raise ValueError("Variant option '%s' expects a value, as in '%s=<value>'" % (key, key))
+        variant[key] = value if value else True
+    return items[0], as_variant(variant)
+
+def service_options(job):
+    # Conversion options of a service job. Unknown options are rejected instead of ignored, so a job
+    # never produces silently different output than the command line. Frames are given as a
+    # '<start>:<end>' string or a [start, end] list
+    options = dict(job.get('options', {}))
+    for key in options:
+        if key not in SERVICE_OPTIONS:
+            raise ValueError("Unknown option '%s'" % key)
+    for variant in job.get('variants', []):
+        for key in variant:
+            if key not in VARIANT_OPTIONS and key != 'output':
+                raise ValueError("Unknown variant option '%s'" % key)
+
+    frames = options.get('frames', None)
+    if isinstance(frames, str):
+        options['frames'] = parse_frames(frames)
+    elif frames is not None:
+        options['frames'] = tuple(frames)
+    return options
+
+def parse_frames(spec):
+    # Frame ranges are given as '<start>:<end>', either end can be omitted
+    start, colon, end = spec.partition(':')
+    if not colon:
+        raise ValueError("Invalid frame range '%s', expected <start>:<end>" % spec)
+    try:
+        start = float(start) if start.strip() else None
+        end = float(end) if end.strip() else None
+    except ValueError:
+        raise ValueError("Invalid frame range '%s', expected <start>:<end>" % spec)
+    if start is not None and end is not None and start >= end:
+        raise ValueError("Empty frame range '%s'" % spec)
+    return (start, end)
+
+def convert(data, encoding = None, **options):
+    # Converts a Bodymovin animation to XAML in memory. 'data' is the JSON document as str, bytes or
+    # an already loaded dict (which is left unchanged). The XAML is returned as str, or bytes if an
+    # encoding is given. Options are the JsonParser arguments: debug, viewbox, template, repeat,
+    # verbose, diagnostics (a Diagnostics to collect warnings into), json_backend, jobs, cache (a
+    # directory where layer fragments are kept for later conversions), markers (a storyboard for
+    # each marker), frames (the (start, end) frames converted, None for the ends), group_static
+    # (static layers are grouped in containers tagged 'Static') and max_keyframe_rate (dense linear
+    # keyframes are resampled to at most this number per second)
+    return convert_variants(data, [None], encoding, **options)[0]
+
+def convert_variants(data, variants, encoding = None, **options):
+    # Same as convert() but the composition is read once and a XAML is returned for each variant.
+    # Variants are dictionaries with any of 'viewbox', 'template' and 'repeat', None uses the options
+    data = load_document(data, options.get('json_backend', None))
+
+    parser = JsonParser(**options)
+    parser.write_composition(parser.read_composition(data))
+    return write_variants(parser, variants, encoding)
+
+def write_variants(parser, variants, encoding = None):
+    documents = []
+    for variant in variants:
+        f = io.StringIO()
+        parser.write_document(f, as_variant(variant) if variant is not None else None)
+        xaml = f.getvalue()
+        documents.append(xaml.encode(encoding) if encoding else xaml)
+
+    return documents
+
+def convert_file(json_file, xaml_file = None, encoding = None, stream = False, **options):
+    # Same as convert() reading from a file. The XAML is also written to 'xaml_file' if given.
+    # With 'stream' layers are decoded one at a time from the memory-mapped file. With 'cache' the
+    # read composition is also kept for later conversions of the same file
+    parser = JsonParser(**options)
+    if stream:
+        parser.read_stream(json_file)
+    else:
+        parser.write_composition(parser.read_file(json_file))
+    xaml = write_variants(parser, [None], encoding)[0]
+
+    if xaml_file:
+        with open(xaml_file, 'wb' if encoding else 'w') as f:
+            f.write(xaml)
+
+    return xaml
+
+def convert_lod(data, tiers = LOD_TIERS, encoding = None, **options):
+    # Same as convert() but also writes a XAML for each level of detail tier from the same read
+    # composition. Returns the (name, xaml, costs) of the full conversion followed by each tier
+    data = load_document(data, options.get('json_backend', None))
+
+    parser = JsonParser(**options)
+    composition = parser.read_composition(data)
+    parser.write_composition(composition)
+    documents = [('full', write_variants(parser, [None], encoding)[0], parser.costs)]
+    for tier in tiers:
+        tier_parser = parser.write_tier(composition, tier)
+        documents.append((tier.name, write_variants(tier_parser, [None], encoding)[0], tier_parser.costs))
+    return documents
+
+def lod_manifest(parser, path):
+    # Manifest of the files written by parse() with tiers, so the runtime can pick one by device
+    # class. Files are relative to the manifest
+    import os
+
+    base = os.path.dirname(os.path.abspath(path))
+    tiers = []
+    for name, file, size, costs in parser.lod:
+        tiers.append({ 'name': name, 'file': os.path.relpath(os.path.abspath(file), base).replace(os.sep, '/'), \
+            'size': size, 'cost': dict(total_cost(costs)._asdict()) })
+    return { 'name': parser.name, 'width': parser.width, 'height': parser.height, 'tiers': tiers }
+
+def run_job(job):
+    # Executes a conversion job of the service. Jobs are dictionaries with an optional 'id', the
+    # JSON as 'data' (inline) or 'input' (file path), an optional 'output' path and 'options'.
+    # 'variants' can replace 'output' by a list of options, each with its own optional 'output'.
+    # Any failure is reported in the response so a bad job never stops the service
+    start = time.time()
+    diagnostics = Diagnostics()
+    response = { 'id': job.get('id', None), 'ok': False }
+
+    try:
+        options = service_options(job)
+
+        if 'data' in job:
+            data = job['data']
+        else:
+            with open(job['input'], 'rb') as f:
+                data = f.read()
+
+        def output(target, xaml):
+            if target.get('output', None):
+                with open(target['output'], 'w') as f:
+                    f.write(xaml)
+                return { 'output': target['output'] }
+            else:
+                return { 'xaml': xaml }
+
+        if 'variants' in job:
+            documents = convert_variants(data, job['variants'], diagnostics = diagnostics, **options)
+            response['variants'] = [output(v, xaml) for v, xaml in zip(job['variants'], documents)]
+        else:
+            response.update(output(job, convert(data, diagnostics = diagnostics, **options)))
+
+        response['ok'] = True
+    except Exception as e:
+        response['error'] = str(e) if isinstance(e, ConversionError) else '%s: %s' % (type(e).__name__, e)
+
+    response['warnings'] = diagnostics.report()['warnings']
+    response['time'] = round((time.time() - start) * 1000.0, 2)
+    return response
+
+def serve_stream(pool, rfile, wfile):
+    # Reads jobs as JSON lines and writes a JSON line response for each one as soon as it is done,
+    # so responses can arrive out of order and must be matched by 'id'
+    import concurrent.futures
+    import threading
+    done = threading.Condition()
+    pending = [0]
+
+    def respond(response):
+        line = json.dumps(response) + '\n'
+        with done:
+            wfile.write(line)
+            wfile.flush()
+
+    def submit(job):
+        # Jobs whose worker failed (a crashed pool for example) get an error response, and are
+        # always counted as finished so the service never waits for them
+        def finish(future):
+            try:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    response = { 'id': job.get('id', None) if isinstance(job, dict) else None, 'ok': False, \
+                        'error': '%s: %s' % (type(e).__name__, e) }
+                respond(response)
+            finally:
+                with done:
+                    pending[0] -= 1
+                    done.notify()
+
+        with done:
+            pending[0] += 1
+        try:
+            future = pool.submit(run_job, job)
+        except Exception as e:
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+        future.add_done_callback(finish)
+
+    for line in rfile:
+        if not line.strip():
+            continue
+
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            respond({ 'id': None, 'ok': False, 'error': 'Invalid job: %s' % e })
+            continue
+
+        submit(job)
+
+    # Responses are written from the pool threads, wait for all of them before closing the stream
+    with done:
+        while pending[0] > 0:
+            done.wait()
+
+def init_service_worker():
+    # Workers load the JSON backend once, before their first job
+    find_json_backend()
+
+def serve(socket_path = None, jobs = None):
+    # Long-running conversion service backed by a warm pool of worker processes. Jobs are read from
+    # stdin (responses written to stdout) or from every connection to the given Unix socket
+    import concurrent.futures
+    import os
+
+    jobs = jobs or os.cpu_count() or 1
+
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer = init_service_worker) as pool:
+        if socket_path:
+            import socketserver
+
+            class Handler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    rfile = io.TextIOWrapper(self.rfile, encoding = 'utf-8')
+                    wfile = io.TextIOWrapper(self.wfile, encoding = 'utf-8', write_through = True)
+                    serve_stream(pool, rfile, wfile)
+
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+            server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+            server.daemon_threads = True
+
+            # Terminating the service must remove the socket file
+            import signal
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                os.remove(socket_path)
+        else:
+            serve_stream(pool, sys.stdin, sys.stdout)
+
+def watch(json_file, xaml_file, variants = [], cache = None, **options):
+    # Converts the file again every time it or the images it references change. Rapid saves are
+    # debounced and, as read compositions and layer fragments are cached, only changed layers are
+    # written again. Runs until interrupted
+    import os
+    import shutil
+    import tempfile
+
+    session_cache = None if cache else tempfile.mkdtemp(prefix = 'json2xaml')
+
+    def stamp(path):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def stamps(files):
+        return dict((path, stamp(path)) for path in files)
+
+    def rebuild():
+        start = time.time()
+        parser = JsonParser(cache = cache or session_cache, **options)
+        try:
+            parser.parse(json_file, xaml_file)
+            for variant_file, variant in variants:
+                with open(variant_file, 'w') as f:
+                    parser.write_document(f, variant)
+            print('= %s converted in %d ms' % (xaml_file, (time.time() - start) * 1000.0))
+        except Exception as e:
+            # Files are often read while being saved, the next change will convert them again.
+            # The files watched so far are kept
+            print(str(e) if isinstance(e, ConversionError) else '%s: %s' % (type(e).__name__, e))
+            return None
+        finally:
+            parser.diagnostics.dump(sys.stdout)
+            sys.stdout.flush()
+
+        # Images are referenced by the XAML, they are watched so the preview can reload them
+        base = os.path.dirname(json_file)
+        images = [os.path.join(base, asset.source) for asset in parser.assets.values() \
+            if not asset.layers and asset.source and not asset.source.startswith('data:')]
+        return [json_file] + images
+
+    # Terminating the watcher must remove the session cache
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        files = rebuild() or [json_file]
+        last = stamps(files)
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            current = stamps(files)
+            if current == last:
+                continue
+
+            while True:
+                time.sleep(WATCH_DEBOUNCE)
+                settled = stamps(files)
+                if settled == current:
+                    break
+                current = settled
+
+            files = rebuild() or files
+            last = stamps(files)
+    finally:
+        if session_cache:
+            shutil.rmtree(session_cache, ignore_errors = True)
 
 def main():
+    import colorama
+    from argparse import ArgumentParser
+
     arg_parser = ArgumentParser(description="Converts from After Effects Bodymovin format to Noesis XAML")
     arg_parser.add_argument("--version", action="version", version="%(prog)s "  + __version__)
     arg_parser.add_argument("--debug", action='store_true', help="dump layers information")
     arg_parser.add_argument("--viewbox", action='store_true', help="use Viewbox as root element")
     arg_parser.add_argument("--template", action='store', metavar='<key>', help="import lottie as a control template resource")
     arg_parser.add_argument("--repeat", action='store', metavar='<behavior>', help="describe how the animation repeats")
-    arg_parser.add_argument("json_file", help="the JSON file to be converted from")
-    arg_parser.add_argument("xaml_file", help="the XAML file to created")
+    arg_parser.add_argument("--markers", action='store_true', help="write a storyboard for each marker instead of one for the whole animation")
+    arg_parser.add_argument("--frames", action='store', metavar='<start>:<end>', help="only convert the given range of frames")
+    arg_parser.add_argument("--max-keyframe-rate", action='store', type=float, metavar='<fps>', help="resample dense linear keyframes to at most this rate")
+    arg_parser.add_argument("--group-static", action='store_true', help="group layers that are never animated in containers that can be cached")
+    arg_parser.add_argument("--report", action='store', metavar='<file>', help="write warnings as a JSON report")
+    arg_parser.add_argument("--variant", action='append', metavar='<file>[,<option>...]', help="also write a variant with other options (viewbox, template=<key>, repeat=<behavior>)")
+    arg_parser.add_argument("--json-backend", action='store', metavar='<name>', default='auto', help="JSON parser: auto, json, %s" % ', '.join(JSON_BACKENDS))
+    arg_parser.add_argument("--timings", action='store_true', help="print the time spent parsing, converting and writing")
+    arg_parser.add_argument("--stream", action='store_true', help="decode layers one at a time to reduce memory usage")
+    arg_parser.add_argument("--cache", action='store', metavar='<dir>', help="keep read compositions and layers in a directory to speed up later conversions")
+    arg_parser.add_argument("--max-error", action='store', type=float, metavar='<tolerance>', help="fail if an animated property deviates more than this from the source")
+    arg_parser.add_argument("--cost", action='store_true', help="print the estimated runtime cost of each layer")
+    arg_parser.add_argument("--budget", action='store', metavar='<name>=<limit>[,...]', help="fail if the estimated cost exceeds a budget (%s)" % ', '.join(Cost._fields))
+    arg_parser.add_argument("--budget-warn", action='store_true', help="only warn when a budget is exceeded")
+    arg_parser.add_argument("--lod", action='store', metavar='<manifest>', help="also write reduced level of detail tiers (%s) and a manifest" % ', '.join(tier.name for tier in LOD_TIERS))
+    arg_parser.add_argument("--watch", action='store_true', help="convert again whenever the JSON file or its images change")
+    arg_parser.add_argument("--serve", action='store_true', help="run as a service converting JSON lines jobs from stdin")
+    arg_parser.add_argument("--socket", action='store', metavar='<path>', help="read service jobs from a Unix socket instead of stdin")
+    arg_parser.add_argument("--jobs", action='store', type=int, metavar='<n>', help="number of worker processes writing layers, or of service workers")
+    arg_parser.add_argument("json_file", nargs='?', help="the JSON file to be converted from")
+    arg_parser.add_argument("xaml_file", nargs='?', help="the XAML file to created")
 
     args = arg_parser.parse_args()
-    json_parser = JsonParser(args.debug, args.viewbox, args.template, args.repeat)
-    json_parser.parse(args.json_file, args.xaml_file)
+
+    if args.serve:
+        serve(args.socket, args.jobs)
+        return
+
+    if not args.json_file or not args.xaml_file:
+        arg_parser.error("json_file and xaml_file are required")
+
+    if args.max_keyframe_rate is not None and args.max_keyframe_rate <= 0:
+        arg_parser.error("--max-keyframe-rate must be positive")
+
+    if args.lod and (args.stream or args.watch):
+        arg_parser.error("--lod can't be used with --stream or --watch")
+
+    try:
+        variants = [parse_variant(spec) for spec in args.variant or []]
+        frames = parse_frames(args.frames) if args.frames else None
+        budget = parse_budget(args.budget) if args.budget else None
+    except ValueError as e:
+        arg_parser.error(str(e))
+
+    colorama.init(autoreset = True)
+    try:
+        find_json_backend(args.json_backend)
+    except ValueError as e:
+        arg_parser.error(str(e))
+
+    if args.watch:
+        try:
+            watch(args.json_file, args.xaml_file, variants, args.cache, debug = args.debug, viewbox = args.viewbox, \
+                template = args.template, repeat = args.repeat, json_backend = args.json_backend, jobs = args.jobs, markers = args.markers, \
+                frames = frames, group_static = args.group_static, max_keyframe_rate = args.max_keyframe_rate)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    json_parser = JsonParser(args.debug, args.viewbox, args.template, args.repeat, verbose = True, json_backend = args.json_backend, jobs = args.jobs, cache = args.cache, \
+        markers = args.markers, frames = frames, group_static = args.group_static, max_keyframe_rate = args.max_keyframe_rate)
+
+    try:
+        json_parser.parse(args.json_file, args.xaml_file, args.stream, LOD_TIERS if args.lod else None)
+
+        if args.lod:
+            with open(args.lod, 'w') as f:
+                json.dump(lod_manifest(json_parser, args.lod), f, indent = 2)
+
+        for xaml_file, variant in variants:
+            with open(xaml_file, 'w') as f:
+                json_parser.write_document(f, variant)
+
+        if args.max_error is not None:
+            with open(args.json_file, 'rb') as f:
+                errors = measure_error(f.read(), json_backend = args.json_backend, frames = frames, max_keyframe_rate = args.max_keyframe_rate)
+            failed = [e for e in errors if e.max_error > args.max_error]
+            print('= max error %s' % (format_float(errors[0].max_error) if errors else '0'))
+            for e in failed:
+                print(colorama.Fore.RED + '%s.%s deviates %s at frame %s' % (e.target, e.property, format_float(e.max_error), format_float(e.frame)))
+            if failed:
+                exit(1)
+
+        if args.cost:
+            for name, cost in json_parser.costs + [('total', total_cost(json_parser.costs))]:
+                print('= %s %s' % (name, ' '.join('%s %d' % (field, value) for field, value in zip(Cost._fields, cost))))
+
+        if budget:
+            exceeded = check_budget(json_parser.costs, budget)
+            for name, total, limit in exceeded:
+                if args.budget_warn:
+                    json_parser.warning("Cost budget exceeded: %s %d > %d" % (name, total, limit))
+                else:
+                    print(colorama.Fore.RED + '%s %d exceeds the budget of %d' % (name, total, limit))
+            if exceeded and not args.budget_warn:
+                exit(1)
+
+        if args.timings:
+            timings = json_parser.timings
+            total = sum(timings.values())
+            for phase in ('cache', 'parse', 'read', 'convert', 'write', 'lod'):
+                if phase in timings:
+                    backend = ' (%s)' % find_json_backend(args.json_backend)[0] if phase == 'parse' else ''
+                    print('= %s %.1f ms %d%%%s' % (phase, timings[phase] * 1000.0, timings[phase] * 100.0 / total if total else 0, backend))
+    except ConversionError as e:
+        print(colorama.Fore.RED + str(e))
+        exit(1)
+    finally:
+        json_parser.diagnostics.dump(sys.stdout)
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(json_parser.diagnostics.report(), f, indent = 2)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
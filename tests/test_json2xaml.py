@@ -0,0 +1,104 @@
+import concurrent.futures
+import copy
+import io
+import json
+import os
+import unittest
+
+import json2xaml
+
+SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samples')
+
+def load_sample(name):
+    with open(os.path.join(SAMPLES, name)) as f:
+        return json.load(f)
+
+class ParentLayersTest(unittest.TestCase):
+    def test_self_parented_layer(self):
+        data = load_sample('wave.json')
+        data['layers'][0]['parent'] = data['layers'][0]['ind']
+        diagnostics = json2xaml.Diagnostics()
+        xaml = json2xaml.convert(data, diagnostics = diagnostics)
+        self.assertIn('x:Name="Layer1"', xaml)
+        self.assertIn("Parent layer '1' is its own ancestor", diagnostics.warnings)
+
+    def test_cyclic_parents(self):
+        data = load_sample('wave.json')
+        data['layers'][0]['parent'] = data['layers'][1]['ind']
+        data['layers'][1]['parent'] = data['layers'][0]['ind']
+        diagnostics = json2xaml.Diagnostics()
+        xaml = json2xaml.convert(data, diagnostics = diagnostics)
+        self.assertIn('x:Name="Layer2"', xaml)
+        self.assertTrue(any('is its own ancestor' in msg for msg in diagnostics.warnings))
+
+class ConvertTest(unittest.TestCase):
+    def test_convert_same_dict_twice(self):
+        data = load_sample('wave.json')
+        source = json.dumps(data, sort_keys = True)
+        first = json2xaml.convert(data)
+        self.assertEqual(json.dumps(data, sort_keys = True), source)
+        self.assertEqual(json2xaml.convert(data), first)
+        self.assertEqual(json2xaml.convert(source), first)
+
+    def test_other_entry_points_keep_dict(self):
+        data = load_sample('wave.json')
+        source = json.dumps(data, sort_keys = True)
+        json2xaml.measure_error(data)
+        json2xaml.estimate_cost(data)
+        json2xaml.convert_lod(data)
+        self.assertEqual(json.dumps(data, sort_keys = True), source)
+
+    def test_full_range_with_duplicate_indices(self):
+        data = load_sample('wave.json')
+        layer = copy.deepcopy(data['layers'][-1])
+        layer['ind'] = data['layers'][0]['ind']
+        layer['ip'] = layer.get('ip', 0) + 10
+        data['layers'].append(layer)
+        self.assertEqual(json2xaml.convert(data, frames = (0, None)), json2xaml.convert(data))
+
+class VariantTest(unittest.TestCase):
+    def test_parse_variant(self):
+        output, variant = json2xaml.parse_variant('out.xaml,viewbox,template=lottie,repeat=Forever')
+        self.assertEqual(output, 'out.xaml')
+        self.assertEqual(variant, json2xaml.Variant(True, 'lottie', 'Forever'))
+
+    def test_option_without_value(self):
+        for spec in ('out.xaml,template', 'out.xaml,repeat', 'out.xaml,repeat='):
+            with self.assertRaises(ValueError):
+                json2xaml.parse_variant(spec)
+
+class ServiceTest(unittest.TestCase):
+    def serve(self, jobs, pool = None):
+        rfile = io.StringIO(''.join(json.dumps(job) + '\n' for job in jobs))
+        wfile = io.StringIO()
+        if pool is None:
+            with concurrent.futures.ThreadPoolExecutor(2) as pool:
+                json2xaml.serve_stream(pool, rfile, wfile)
+        else:
+            json2xaml.serve_stream(pool, rfile, wfile)
+        return dict((r['id'], r) for r in map(json.loads, wfile.getvalue().splitlines()))
+
+    def test_conversion_options(self):
+        data = load_sample('wave.json')
+        responses = self.serve([{ 'id': 1, 'data': data, 'options': { 'frames': '5:20', 'group_static': True } }])
+        self.assertTrue(responses[1]['ok'])
+        self.assertEqual(responses[1]['xaml'], json2xaml.convert(data, frames = (5.0, 20.0), group_static = True))
+
+    def test_unknown_option(self):
+        responses = self.serve([{ 'id': 1, 'data': load_sample('wave.json'), 'options': { 'precision': 1 } }])
+        self.assertFalse(responses[1]['ok'])
+        self.assertIn("Unknown option 'precision'", responses[1]['error'])
+
+    def test_failed_worker(self):
+        class BrokenPool:
+            def submit(self, fn, *args):
+                future = concurrent.futures.Future()
+                future.set_exception(RuntimeError('worker died'))
+                return future
+
+        responses = self.serve([{ 'id': 1, 'data': {} }, { 'id': 2, 'data': {} }], BrokenPool())
+        self.assertEqual(sorted(responses), [1, 2])
+        self.assertIn('worker died', responses[2]['error'])
+
+if __name__ == '__main__':
+    unittest.main()